@@ -0,0 +1,62 @@
+import glob
+import importlib.util
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_app(challenge):
+    # Both challenges ship a module called app.py, so load them under distinct names.
+    path = os.path.join(REPO_ROOT, challenge, "app.py")
+    name = f"{challenge}_app"
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def challenge_1a_pdfs():
+    return sorted(glob.glob(os.path.join(REPO_ROOT, "challenge_1a", "input", "*.pdf")))
+
+def challenge_1b_pdfs():
+    return sorted(glob.glob(os.path.join(REPO_ROOT, "challenge_1b", "Collection *", "PDFs", "*.pdf")))
+
+def challenge_1b_inputs():
+    return sorted(glob.glob(os.path.join(REPO_ROOT, "challenge_1b", "Collection *", "challenge1b_input.json")))
+
+def build_dense_pdf(path, pages, seed=0, body_size=10):
+    # A long report-style PDF: a numbered heading every few paragraphs and
+    # dense multi-span body lines, so pages carry a few hundred spans each.
+    # body_size need not be round: PDFs often store sizes like 10.04pt.
+    import random
+
+    import fitz
+
+    rng = random.Random(seed)
+    words = ("market budget travel network layer protocol analysis report figure results method "
+             "dataset planning hotel recipe buffet summary revenue growth customer design").split()
+    doc = fitz.open()
+    section = 0
+    for _ in range(pages):
+        page = doc.new_page()
+        y = 60
+        while y < page.rect.height - 70:
+            if rng.random() < 0.08:
+                section += 1
+                page.insert_text((72, y + 8), f"{section}. {rng.choice(words).title()} {rng.choice(words).title()}",
+                                 fontsize=16, fontname="hebo")
+                y += 28
+                continue
+            x = 72
+            for _ in range(rng.randint(3, 6)):
+                text = " ".join(rng.choice(words) for _ in range(rng.randint(2, 4)))
+                font = "hebo" if rng.random() < 0.1 else "helv"
+                page.insert_text((x, y), text, fontsize=body_size, fontname=font)
+                x += fitz.get_text_length(text, fontname=font, fontsize=body_size) + 4
+                if x > page.rect.width - 150:
+                    break
+            y += 14
+    doc.save(path)
+    doc.close()
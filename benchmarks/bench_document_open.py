@@ -0,0 +1,107 @@
+"""Compare the ways a worker process can get at a PDF: path, bytes, mmap, shared memory.
+
+Usage: python benchmarks/bench_document_open.py [--pages N] [--workers N] [pdf ...]
+Without PDFs, builds a synthetic scanned-style PDF (one incompressible image
+plus a text layer per page, about 0.5 MB per page) in a temporary folder.
+For every mode a fresh pool of workers opens the same document and extracts
+its spans; the table shows the parent's preparation time, the wall time of
+the workers and their peak RSS, so copies of the PDF show up as extra memory.
+"""
+import argparse
+import mmap
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+from _common import load_app
+
+def build_scanned_pdf(path, pages):
+    doc = fitz.open()
+    for page_index in range(pages):
+        page = doc.new_page()
+        noise = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 700, 700), 0)
+        noise.set_rect(noise.irect, (0,))
+        noise.samples_mv[:] = os.urandom(len(noise.samples_mv))
+        page.insert_image(page.rect, pixmap=noise)
+        page.insert_text((72, 72), f"Chapter {page_index + 1}", fontsize=18)
+        for line in range(30):
+            page.insert_text((72, 110 + line * 20), f"Body line {line} of scanned page {page_index + 1}", fontsize=10)
+    doc.save(path)
+    doc.close()
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def extract(doc, app):
+    spans = 0
+    with app.ParsedDocument(doc) as parsed:
+        for page_index in range(len(parsed)):
+            spans += len(parsed.page(page_index).spans)
+            parsed.release(page_index)
+    return spans, peak_rss_mb()
+
+def open_source(source):
+    return extract(source.open(), load_app("challenge_1a"))
+
+def open_mmap(path):
+    # PyMuPDF rejects mmap and memoryview streams, so the mapping has to be
+    # copied into bytes before MuPDF can see it.
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return extract(fitz.open(stream=bytes(mapped), filetype="pdf"), load_app("challenge_1a"))
+
+def run_mode(name, path, workers, app):
+    shm = None
+    start = time.perf_counter()
+    if name == "path":
+        target, args = open_source, app.DocumentSource.from_path(path)
+    elif name == "bytes":
+        with open(path, "rb") as f:
+            target, args = open_source, app.DocumentSource.from_bytes(f.read(), os.path.basename(path))
+    elif name == "mmap":
+        target, args = open_mmap, path
+    else:
+        source, shm = app.DocumentSource.to_shared_memory(path)
+        if shm is None:
+            raise SystemExit(f"{path} does not fit in {app.SHARED_MEMORY_DIR}")
+        target, args = open_source, source
+    prepare = time.perf_counter() - start
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pool.submit(peak_rss_mb).result()  # start the workers outside the timing
+            start = time.perf_counter()
+            results = list(pool.map(target, [args] * workers))
+            elapsed = time.perf_counter() - start
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    return prepare, elapsed, max(rss for _, rss in results), results[0][0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pdfs", nargs="*")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    app = load_app("challenge_1a")
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.pdfs
+        if not paths:
+            paths = [os.path.join(tmp, "scanned.pdf")]
+            build_scanned_pdf(paths[0], args.pages)
+
+        for path in paths:
+            print(f"{os.path.basename(path)}: {os.path.getsize(path) / 2**20:.1f} MB, {args.workers} workers")
+            print(f"{'mode':<8}{'prepare (s)':>13}{'workers (s)':>13}{'peak RSS MB':>13}{'spans':>9}")
+            for mode in ("path", "bytes", "mmap", "shm"):
+                prepare, elapsed, rss, spans = run_mode(mode, path, args.workers, app)
+                print(f"{mode:<8}{prepare:>13.3f}{elapsed:>13.3f}{rss:>13.1f}{spans:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Micro-benchmark of persona keyword scoring: one str.count per keyword versus
+the single-pass KeywordMatcher built in setup_persona_keywords.
+
+Usage: python benchmarks/bench_keyword_scoring.py [job word count]
+Scores every section of the bundled challenge_1b collections for a travel
+planner persona whose job text contributes the given number of extra keywords.
+"""
+import random
+import re
+import sys
+import time
+
+from _common import challenge_1b_pdfs, load_app
+
+def legacy_keyword_score(importance_keywords, section):
+    title = section.get("section_title", "").lower()
+    content = section.get("content", "").lower()
+    text = title + " " + content
+    score = 0
+    for keyword in importance_keywords.get('high', []):
+        score += title.count(keyword.lower()) * 5 + content.count(keyword.lower()) * 3
+    for keyword in importance_keywords.get('medium', []):
+        score += text.count(keyword.lower()) * 2
+    return score
+
+def timed(function, sections, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        scores = [function(section) for section in sections]
+        best = min(best, time.perf_counter() - start)
+    return best, scores
+
+def main(job_words):
+    app = load_app("challenge_1b")
+    analyzer = app.PersonaDrivenAnalyzer()
+    sections = []
+    for path in challenge_1b_pdfs():
+        sections.extend(analyzer.get_document_sections(path, path.rsplit("/", 1)[-1]).materialized())
+
+    vocabulary = sorted(set(re.findall(r"\b\w{4,}\b", " ".join(s["content"] for s in sections).lower())))
+    job = " ".join(random.Random(0).sample(vocabulary, min(job_words, len(vocabulary))))
+    analyzer.setup_persona_keywords({"role": "Travel Planner"}, {"task": job})
+    keyword_count = sum(len(keywords) for keywords in analyzer.importance_keywords.values())
+
+    def matcher_score(section):
+        return analyzer.keyword_matcher.score(section.get("section_title", "").lower(),
+                                              section.get("content", "").lower())
+
+    legacy_time, legacy_scores = timed(lambda s: legacy_keyword_score(analyzer.importance_keywords, s), sections, 3)
+    matcher_time, matcher_scores = timed(matcher_score, sections, 3)
+
+    print(f"{len(sections)} sections, {keyword_count} keywords")
+    print(f"str.count loop  {legacy_time:.4f} s")
+    print(f"KeywordMatcher  {matcher_time:.4f} s")
+    print(f"speedup {legacy_time / matcher_time:.1f}x, identical scores: {legacy_scores == matcher_scores}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 120)
@@ -0,0 +1,242 @@
+"""Throughput and regression benchmark over the bundled corpora and synthetic PDFs.
+
+Usage: python benchmarks/bench_suite.py [--repeat N] [--threshold 0.25]
+                                        [--baseline benchmarks/baseline.json] [--update-baseline]
+Scenarios:
+  1a-input       extract_outline_from_doc over challenge_1a/input
+  1a-synthetic   the same over generated long reports (dense spans, many pages)
+  1b-collections process_document_collection over the three bundled collections
+  1b-synthetic   one collection of generated reports for the travel planner persona
+Each scenario runs in a fresh process (so peak RSS is its own), `--repeat`
+times; the best figures are reported as pages/sec, spans/sec, p50/p95
+per-document latency and peak RSS. Outputs of the bundled corpora must match
+the committed output/*.json files. The results are compared with the stored
+baseline, and the script exits non-zero on a mismatch or when a scenario is
+slower (throughput or p95) or bigger (RSS) than the baseline by more than the
+threshold. It also fails when --document-font-stats flags other heading spans
+or builds other sections than the per-page default in a generated report
+whose body text is 10.04pt (between the histogram's 0.1pt bins). Baselines
+are machine-specific: refresh them with --update-baseline on the machine that
+runs the comparison.
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+from _common import REPO_ROOT, build_dense_pdf, challenge_1a_pdfs, challenge_1b_inputs, load_app
+
+SYNTHETIC_PAGES = (40, 150, 400)
+SCENARIOS = ("1a-input", "1a-synthetic", "1b-collections", "1b-synthetic")
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def synthetic_pdfs(workdir):
+    paths = []
+    for seed, pages in enumerate(SYNTHETIC_PAGES):
+        path = os.path.join(workdir, f"report_{pages}p.pdf")
+        if not os.path.exists(path):
+            build_dense_pdf(path, pages, seed=seed)
+        paths.append(path)
+    return paths
+
+def synthetic_collection(workdir):
+    collection = os.path.join(workdir, "Synthetic Collection")
+    os.makedirs(os.path.join(collection, "PDFs"), exist_ok=True)
+    documents = []
+    for path in synthetic_pdfs(workdir):
+        target = os.path.join(collection, "PDFs", os.path.basename(path))
+        if not os.path.exists(target):
+            shutil.copyfile(path, target)
+        documents.append({"filename": os.path.basename(path), "title": os.path.basename(path)[:-4]})
+    config = {
+        "documents": documents,
+        "persona": {"role": "Travel Planner"},
+        "job_to_be_done": {"task": "Plan a budget trip with hotel and market recommendations"},
+    }
+    input_path = os.path.join(collection, "challenge1b_input.json")
+    with open(input_path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    return [input_path]
+
+def font_stats_mismatches(workdir):
+    # Document-wide statistics round sizes to 0.1pt; body text just above its
+    # rounded size must still not be taken for headings.
+    path = os.path.join(workdir, "report_10.04pt.pdf")
+    build_dense_pdf(path, 3, body_size=10.04)
+    app_1a = load_app("challenge_1a")
+    app_1b = load_app("challenge_1b")
+    analyzer = app_1b.PersonaDrivenAnalyzer()
+    results = []
+    for document_font_stats in (False, True):
+        font_statistics = app_1a.FontStatistics() if document_font_stats else None
+        with app_1a.ParsedDocument(fitz.open(path), font_statistics=font_statistics) as doc:
+            headings = []
+            for page_index in range(len(doc)):
+                spans, flags, _, _ = app_1a.classify_page_spans(doc, page_index)
+                headings.extend(span.text for span, heading in zip(spans, flags) if heading)
+        font_statistics = app_1b.FontStatistics() if document_font_stats else None
+        with app_1b.ParsedDocument(fitz.open(path), font_statistics=font_statistics) as doc:
+            sections, _ = analyzer.extract_enhanced_sections_from_doc(doc, os.path.basename(path))
+        results.append((headings, [section["section_title"] for section in sections.materialized()]))
+    (headings, sections), (stats_headings, stats_sections) = results
+    mismatches = []
+    if headings != stats_headings:
+        mismatches.append(f"1a: {len(stats_headings)} heading spans with --document-font-stats, {len(headings)} without")
+    if sections != stats_sections:
+        mismatches.append(f"1b: {len(stats_sections)} sections with --document-font-stats, {len(sections)} without")
+    return mismatches
+
+def run_outlines(paths, check):
+    app = load_app("challenge_1a")
+    latencies, pages, spans, mismatches = [], 0, 0, []
+    for path in paths:
+        start = time.perf_counter()
+        metrics = app.StageMetrics(os.path.basename(path))
+        with app.ParsedDocument(fitz.open(path), metrics) as doc:
+            title = app.extract_title_from_first_page(doc)
+            buffer = io.StringIO()
+            app.write_outline_json(buffer, title, app.iter_outline_from_doc(doc, doc_title=title))
+        latencies.append(time.perf_counter() - start)
+        pages += metrics.counters["pages"]
+        spans += metrics.counters["spans"]
+
+        if check:
+            expected = os.path.join(REPO_ROOT, "challenge_1a", "output", os.path.basename(path)[:-4] + ".json")
+            with open(expected, encoding="utf-8") as f:
+                if f.read() != buffer.getvalue():
+                    mismatches.append(os.path.basename(expected))
+    return latencies, pages, spans, mismatches
+
+def run_collections(input_paths, check):
+    app = load_app("challenge_1b")
+    analyzer = app.PersonaDrivenAnalyzer(collect_metrics=True)
+    mismatches = []
+    for input_path in input_paths:
+        result = analyzer.process_document_collection(input_path)
+        if check:
+            name = os.path.basename(os.path.dirname(input_path))
+            with open(os.path.join(REPO_ROOT, "challenge_1b", "output", f"{name}_output.json"), encoding="utf-8") as f:
+                expected = json.load(f)
+            for output in (result, expected):
+                output["metadata"].pop("processing_timestamp", None)
+            if result != expected:
+                mismatches.append(f"{name}_output.json")
+    # Scoring and selection are timed per collection; extraction per document
+    documents = analyzer.document_metrics
+    latencies = [entry["seconds"] for entry in documents]
+    pages = sum(entry["counters"].get("pages", 0) for entry in documents)
+    spans = sum(entry["counters"].get("spans", 0) for entry in documents)
+    return latencies, pages, spans, mismatches
+
+def run_scenario(name, workdir):
+    # Runs in a fresh worker process; the parent only builds the synthetic inputs.
+    # Module imports (fitz, numpy) are kept out of the timing.
+    load_app("challenge_1a")
+    load_app("challenge_1b")
+    start = time.perf_counter()
+    if name == "1a-input":
+        latencies, pages, spans, mismatches = run_outlines(challenge_1a_pdfs(), check=True)
+    elif name == "1a-synthetic":
+        latencies, pages, spans, mismatches = run_outlines(synthetic_pdfs(workdir), check=False)
+    elif name == "1b-collections":
+        latencies, pages, spans, mismatches = run_collections(challenge_1b_inputs(), check=True)
+    else:
+        latencies, pages, spans, mismatches = run_collections(synthetic_collection(workdir), check=False)
+    seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return latencies, pages, spans, seconds, peak_rss, mismatches
+
+def measure(name, workdir, repeat):
+    # Every figure is the best over the repeats (per document for latencies),
+    # which keeps scheduler noise out of the comparison with the baseline.
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            runs.append(pool.submit(run_scenario, name, workdir).result())
+    latencies = [min(values) for values in zip(*(run[0] for run in runs))]
+    _, pages, spans, _, _, mismatches = runs[0]
+    seconds = min(run[3] for run in runs)
+    return {
+        "documents": len(latencies),
+        "pages": pages,
+        "spans": spans,
+        "seconds": round(seconds, 4),
+        "pages_per_sec": round(pages / seconds, 1),
+        "spans_per_sec": round(spans / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "peak_rss_mb": round(min(run[4] for run in runs), 1),
+        "mismatches": sorted(set().union(*(run[5] for run in runs))),
+    }
+
+def regressions(name, result, baseline, threshold):
+    found = []
+    if result["pages_per_sec"] < baseline["pages_per_sec"] * (1 - threshold):
+        found.append(f"pages/sec {result['pages_per_sec']} < baseline {baseline['pages_per_sec']}")
+    for key in ("p95_ms", "peak_rss_mb"):
+        if result[key] > baseline[key] * (1 + threshold):
+            found.append(f"{key} {result[key]} > baseline {baseline[key]}")
+    return [f"{name}: {message}" for message in found]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative slowdown or memory growth against the baseline")
+    parser.add_argument("--baseline", default=os.path.join(REPO_ROOT, "benchmarks", "baseline.json"))
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="run only this scenario (repeatable)")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as workdir:
+        synthetic_pdfs(workdir)
+        for mismatch in font_stats_mismatches(workdir):
+            failures.append(f"document font stats on 10.04pt body text: {mismatch}")
+        print(f"{'scenario':<16}{'docs':>6}{'pages':>7}{'pages/s':>10}{'spans/s':>11}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'RSS MB':>8}  outputs")
+        for name in args.scenario or SCENARIOS:
+            result = measure(name, workdir, max(1, args.repeat))
+            results[name] = result
+            checked = "match" if name in ("1a-input", "1b-collections") else "-"
+            if result["mismatches"]:
+                checked = f"DIFF {', '.join(result['mismatches'])}"
+                failures.append(f"{name}: outputs differ from output/*.json: {', '.join(result['mismatches'])}")
+            print(f"{name:<16}{result['documents']:>6}{result['pages']:>7}{result['pages_per_sec']:>10.1f}"
+                  f"{result['spans_per_sec']:>11.1f}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}"
+                  f"{result['peak_rss_mb']:>8.1f}  {checked}")
+            if name in baseline and not args.update_baseline:
+                failures.extend(regressions(name, result, baseline[name], args.threshold))
+
+    if args.update_baseline:
+        baseline.update({name: {key: value for key, value in result.items() if key != "mismatches"}
+                         for name, result in results.items()})
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""Compare the full get_text("dict") span extraction with the text-only backend.
+
+Usage: python benchmarks/bench_text_extraction.py [pdf ...]
+Defaults to every PDF bundled with challenge_1a and challenge_1b.
+"""
+import sys
+import time
+import tracemalloc
+
+import fitz
+
+from _common import challenge_1a_pdfs, challenge_1b_pdfs, load_app
+
+def legacy_extract(doc):
+    # The pre-backend path: full "dict" output with images, MuPDF span dicts
+    # mutated in place and kept alive.
+    pages = []
+    for page_index in range(len(doc)):
+        page = doc[page_index]
+        spans_list = []
+        for block in page.get_text("dict")["blocks"]:
+            if "lines" not in block:
+                continue
+            for line in block["lines"]:
+                spans = line["spans"]
+                span_count = len([s for s in spans if s["text"].strip()])
+                total_width = sum(s["bbox"][2] - s["bbox"][0] for s in spans)
+                avg_width = total_width / span_count if span_count else 100
+                for span in spans:
+                    span["text"] = span["text"].strip()
+                    span["font_size"] = span.get("size", 0)
+                    span["y"] = span["bbox"][1]
+                    span["page"] = page_index + 1
+                    span["span_count_on_line"] = span_count
+                    span["avg_span_width"] = avg_width
+                    spans_list.append(span)
+        pages.append(spans_list)
+    return pages
+
+def backend_extract(doc, app):
+    return [app.parse_page_spans(doc[page_index], page_index).spans for page_index in range(len(doc))]
+
+def measure(extract, paths):
+    # Peak covers the transient MuPDF output, retained is what the span
+    # records still hold once a document has been extracted.
+    elapsed = 0.0
+    peak = 0
+    retained = 0
+    for path in paths:
+        doc = fitz.open(path)
+        tracemalloc.start()
+        start = time.perf_counter()
+        pages = extract(doc)
+        elapsed += time.perf_counter() - start
+        current, doc_peak = tracemalloc.get_traced_memory()
+        peak = max(peak, doc_peak)
+        retained = max(retained, current)
+        tracemalloc.stop()
+        del pages
+        doc.close()
+    return elapsed, peak, retained
+
+def main(paths):
+    app = load_app("challenge_1a")
+    # Warm up MuPDF's font and glyph caches so neither side pays them alone.
+    measure(legacy_extract, paths)
+
+    legacy = measure(legacy_extract, paths)
+    backend = measure(lambda doc: backend_extract(doc, app), paths)
+
+    print(f"{len(paths)} PDFs")
+    print(f"{'':<10}{'time (s)':>12}{'peak MB/doc':>14}{'retained MB/doc':>18}")
+    for name, (elapsed, peak, retained) in (("legacy", legacy), ("backend", backend)):
+        print(f"{name:<10}{elapsed:>12.3f}{peak / 2**20:>14.2f}{retained / 2**20:>18.2f}")
+    print(f"speedup {legacy[0] / backend[0]:.2f}x, "
+          f"peak memory {backend[1] / legacy[1]:.0%} of legacy, "
+          f"retained memory {backend[2] / legacy[2]:.0%} of legacy")
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or challenge_1a_pdfs() + challenge_1b_pdfs())
@@ -0,0 +1,91 @@
+"""Benchmark the near-duplicate title check of the challenge_1b diversity loop.
+
+Usage: python benchmarks/bench_title_dedup.py [sections]
+Builds a synthetic corpus of section titles (default 50,000) with many
+prefix/suffix variants of the same heading, then deduplicates every title
+against all previously kept ones: once with the original any(...) scan and
+once with TitleDeduplicator. The scan is quadratic, so it is only run on a
+prefix of the corpus that finishes in reasonable time.
+"""
+import random
+import sys
+import time
+
+from _common import load_app
+
+WORDS = ("travel guide hotel beach cuisine history wine market coastal village festival "
+         "recipe dinner salad vegetarian buffet acrobat export share signature form "
+         "introduction overview summary tips tricks planning budget packing nightlife").split()
+
+def synthetic_titles(count, seed=0):
+    rng = random.Random(seed)
+    # Real headings plus invented words, so most titles are distinct and the
+    # seen-title set grows with the corpus.
+    words = list(WORDS) + ["".join(rng.choice("etaoinshrdlu") for _ in range(rng.randint(4, 9)))
+                           for _ in range(3000)]
+    titles = []
+    for _ in range(count):
+        base = " ".join(rng.choice(words) for _ in range(rng.randint(2, 6)))
+        variant = rng.random()
+        if variant < 0.2 and titles:
+            base = rng.choice(titles) + " " + rng.choice(WORDS)
+        elif variant < 0.3 and titles:
+            base = rng.choice(titles).split(" ", 1)[-1]
+        titles.append(base)
+    return titles
+
+def naive_dedup(titles):
+    seen_titles = set()
+    kept = []
+    for title_lower in titles:
+        is_duplicate = any(title_lower in seen.lower() or seen.lower() in title_lower
+                           for seen in seen_titles if len(title_lower) > 10)
+        if not is_duplicate:
+            kept.append(title_lower)
+            seen_titles.add(title_lower)
+    return kept
+
+def indexed_dedup(app, titles):
+    seen_titles = app.TitleDeduplicator()
+    kept = []
+    for title_lower in titles:
+        if not (len(title_lower) > 10 and seen_titles.overlaps(title_lower)):
+            kept.append(title_lower)
+            seen_titles.add(title_lower)
+    return kept
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def main(count):
+    app = load_app("challenge_1b")
+    titles = synthetic_titles(count)
+
+    naive_count = min(count, 5000)
+    naive_time, naive_kept = timed(naive_dedup, titles[:naive_count])
+    prefix_time, prefix_kept = timed(indexed_dedup, app, titles[:naive_count])
+    print(f"{naive_count} titles: any() scan {naive_time:.3f} s, TitleDeduplicator {prefix_time:.3f} s, "
+          f"{naive_time / prefix_time:.0f}x, same result: {naive_kept == prefix_kept}")
+
+    full_time, full_kept = timed(indexed_dedup, app, titles)
+    print(f"{count} titles: TitleDeduplicator {full_time:.3f} s "
+          f"({full_time / count * 1e6:.1f} us per lookup, {len(full_kept)} kept)")
+
+    # The collection output itself keeps at most 25 sections: run the real
+    # selection over a ranked synthetic corpus to show the common case.
+    analyzer = app.PersonaDrivenAnalyzer()
+    rng = random.Random(1)
+    sections = [{
+        "document": f"doc{rng.randrange(200)}.pdf",
+        "section_title": title.title(),
+        "page_number": rng.randint(1, 40),
+        "content": "",
+    } for title in titles]
+    selection_time, output = timed(analyzer.build_collection_output, [], {}, {}, sections)
+    print(f"build_collection_output over {count} ranked sections: {selection_time:.4f} s, "
+          f"{len(output['extracted_sections'])} selected")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -2,19 +2,65 @@ import fitz
 import os
 import json
 import time
+import argparse
+import contextlib
+import cProfile
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import multiprocessing
+import queue
 import string
+import threading
 import re
-from collections import Counter
+import signal
+import sys
+import tracemalloc
+from array import array
+from multiprocessing import shared_memory
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # Windows: peak memory is reported as 0.0
+    resource = None
+
+try:
+    import numpy as np
+except ImportError:  # classify_page_spans falls back to per-span is_heading calls
+    np = None
+
+# Text-only extraction: image blocks (and their raw bytes) are never built.
+# Ligatures and whitespace are still preserved because dropping them changes
+# the span text and therefore the extracted titles and headings.
+TEXT_EXTRACTION_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+class Span:
+    # One text span, kept as a slotted record instead of the MuPDF span dict:
+    # only the fields the title and heading heuristics read are stored.
+    __slots__ = ("text", "font_size", "y", "width", "page", "span_count_on_line", "avg_span_width")
+
+    def __init__(self, text, font_size, y, width, page, span_count_on_line, avg_span_width):
+        self.text = text
+        self.font_size = font_size
+        self.y = y
+        self.width = width
+        self.page = page
+        self.span_count_on_line = span_count_on_line
+        self.avg_span_width = avg_span_width
 
 def is_header_or_footer_block(span, page_height, header_limit=50, footer_limit=50):
-    y_position = span["bbox"][1]
+    y_position = span.y
     return y_position <= header_limit or y_position >= (page_height - footer_limit)
 
 def is_title_candidate(span, page_number):
     if page_number != 1:
         return False
 
-    text = span['text'].strip()
+    text = span.text.strip()
     if not text or not any(c.isalpha() for c in text):
         return False
     if sum(1 for c in text if c in string.punctuation) / len(text) > 0.6:
@@ -27,24 +73,17 @@ def is_title_candidate(span, page_number):
     if text.isupper() and len(text.split()) <= 5:
         return False
 
-    bbox_width = span['bbox'][2] - span['bbox'][0]
-    font_size = span.get("size", 0)
-    return font_size >= 10 and bbox_width >= 100
+    return span.font_size >= 10 and span.width >= 100
 
 def extract_title_from_first_page(doc):
     potential_titles = []
-    first_page = doc[0]
-    for block in first_page.get_text("dict")["blocks"]:
-        if "lines" not in block:
-            continue
-        for line in block["lines"]:
-            for span in line["spans"]:
-                if is_title_candidate(span, 1):
-                    potential_titles.append({
-                        "text": span["text"].strip(),
-                        "y": span["bbox"][1],
-                        "font_size": span["size"]
-                    })
+    for span in as_parsed_document(doc).page(0).spans:
+        if is_title_candidate(span, 1):
+            potential_titles.append({
+                "text": span.text.strip(),
+                "y": span.y,
+                "font_size": span.font_size
+            })
 
     if not potential_titles:
         return ""
@@ -63,17 +102,21 @@ def extract_title_from_first_page(doc):
 
     return " ".join(combined_title)
 
-def is_heading(span, body_font_size, page_height):
-    text = span["text"].strip()
+def is_heading_text(text):
     if not text or len(text) < 3:
         return False
     if text.count(" ") > 10 and not text.endswith(":"):
         return False
-    if span.get("span_count_on_line", 1) > 6:
+    return True
+
+def is_heading(span, body_font_size, page_height):
+    if not is_heading_text(span.text.strip()):
         return False
-    if span.get("avg_span_width", 100) < 40:
+    if span.span_count_on_line > 6:
         return False
-    if span["font_size"] <= body_font_size:
+    if span.avg_span_width < 40:
+        return False
+    if span.font_size <= body_font_size:
         return False
     if is_header_or_footer_block(span, page_height):
         return False
@@ -90,12 +133,275 @@ def classify_heading_level(text):
         return "H4"
     return None
 
-def extract_spans_from_page(doc, page_index):
-    page = doc[page_index]
-    page_height = page.rect.height
-    blocks = page.get_text("dict")["blocks"]
-    spans_list = []
-    font_sizes = []
+class StageMetrics:
+    # Wall-clock seconds per pipeline stage plus counters for one document or
+    # collection. Stage timers nest, and each stage keeps only its exclusive
+    # time, so the stage totals add up to the measured time.
+    __slots__ = ("name", "stages", "counters", "_active")
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.counters = Counter()
+        self._active = None
+
+    def stage(self, stage):
+        return _StageTimer(self, stage)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def merge(self, report):
+        # Adds the stages and counters of an as_dict() report, e.g. of one
+        # page-range shard of this document processed by another worker.
+        for stage, seconds in report["stages"].items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.counters.update(report["counters"])
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "seconds": round(sum(self.stages.values()), 6),
+            "stages": {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+class _StageTimer:
+    __slots__ = ("metrics", "stage", "parent", "nested", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.parent = self.metrics._active
+        self.metrics._active = self
+        self.nested = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        metrics = self.metrics
+        metrics._active = self.parent
+        if self.parent is not None:
+            self.parent.nested += elapsed
+        metrics.stages[self.stage] = metrics.stages.get(self.stage, 0.0) + elapsed - self.nested
+        return False
+
+_NO_STAGE = contextlib.nullcontext()
+
+def stage_timer(metrics, stage):
+    # Hot paths call this unconditionally: without metrics it is a shared no-op.
+    return _NO_STAGE if metrics is None else metrics.stage(stage)
+
+def peak_rss_mb(children=False):
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return round(usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 1024), 1)
+
+def current_rss_mb():
+    # Resident memory right now (Linux), which unlike ru_maxrss also goes down.
+    # Without /proc the peak stands in for it; None when neither is available.
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except OSError:
+        return peak_rss_mb() if resource is not None else None
+
+class MuPDFStoreLimit:
+    # MuPDF keeps fonts, images and parsed objects of every document in one
+    # process-wide store that only evicts at its compiled-in 256 MB, and
+    # PyMuPDF can neither lower that limit nor report the store's size. The
+    # cap is enforced between documents instead: once the process has grown
+    # more than max_mb since the store was last emptied, the store and the
+    # glyph cache are emptied (0 = after every document). Documents never
+    # share entries, so nothing a later document could use is lost.
+    __slots__ = ("max_mb", "baseline_mb")
+
+    def __init__(self, max_mb=0):
+        self.max_mb = max_mb
+        self.baseline_mb = None
+
+    def after_document(self):
+        # Memory is only measured under a limit; when it cannot be measured
+        # the stores are emptied as with no limit
+        if self.max_mb > 0:
+            rss_mb = current_rss_mb()
+            if rss_mb is not None and self.baseline_mb is not None and rss_mb - self.baseline_mb <= self.max_mb:
+                return
+        fitz.TOOLS.store_shrink(100)
+        fitz.TOOLS.glyph_cache_empty()
+        if self.max_mb > 0:
+            self.baseline_mb = current_rss_mb()
+
+MUPDF_STORE_LIMIT = MuPDFStoreLimit()
+
+def limit_mupdf_store(max_mb):
+    # Sets this process's MuPDFStoreLimit; also the initializer of worker pools
+    MUPDF_STORE_LIMIT.max_mb = max_mb
+
+def run_profiled(profile_base, function, *args):
+    # Runs function(*args) under cProfile and tracemalloc, leaving
+    # <profile_base>.prof (for pstats/snakeviz) and <profile_base>.tracemalloc.txt.
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        return function(*args)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(profile_base + ".prof")
+        with open(profile_base + ".tracemalloc.txt", "w", encoding="utf-8") as f:
+            f.write(f"peak traced memory: {peak / 2**20:.2f} MB\n")
+            for stat in snapshot.statistics("lineno")[:25]:
+                f.write(f"{stat}\n")
+
+def keep_slowest_profiles(profile_dir, documents, keep):
+    # Every document is profiled; only the `keep` slowest dumps are left behind.
+    ranked = sorted(documents, key=lambda entry: entry["seconds"], reverse=True)
+    for entry in ranked[keep:]:
+        for suffix in (".prof", ".tracemalloc.txt"):
+            path = os.path.join(profile_dir, entry["name"] + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+def write_metrics_json(path, wall_seconds, documents, collections=()):
+    # documents and collections are StageMetrics.as_dict() entries; worker
+    # processes add their own peak_rss_mb to the documents they handled.
+    stages = Counter()
+    counters = Counter()
+    for entry in list(documents) + list(collections):
+        stages.update(entry["stages"])
+        counters.update(entry["counters"])
+    worker_rss = [entry["peak_rss_mb"] for entry in documents if "peak_rss_mb" in entry]
+    report = {
+        "wall_seconds": round(wall_seconds, 6),
+        "peak_rss_mb": {
+            "main": peak_rss_mb(),
+            "workers": max(worker_rss + [peak_rss_mb(children=True)]),
+        },
+        "stages": {stage: round(seconds, 6) for stage, seconds in sorted(stages.items())},
+        "counters": dict(sorted(counters.items())),
+        "collections": list(collections),
+        "documents": sorted(documents, key=lambda entry: entry["name"]),
+    }
+    if not report["collections"]:
+        del report["collections"]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+class ParsedPage:
+    # The spans of one page plus their numeric fields as flat float columns,
+    # collected while parsing so classify_page_spans can view them as arrays.
+    # prefiltered marks a page whose spans were never built because the cheap
+    # tier of parse_page_spans proved it holds no heading candidate.
+    __slots__ = ("spans", "height", "sizes", "ys", "span_counts", "avg_widths", "prefiltered")
+
+    def __init__(self, height):
+        self.spans = []
+        self.height = height
+        self.prefiltered = False
+        self.sizes = array("d")
+        self.ys = array("d")
+        self.span_counts = array("d")
+        self.avg_widths = array("d")
+
+    def add(self, span):
+        self.spans.append(span)
+        self.sizes.append(span.font_size)
+        self.ys.append(span.y)
+        self.span_counts.append(span.span_count_on_line)
+        self.avg_widths.append(span.avg_span_width)
+
+class ParsedDocument:
+    # Every page is decoded by MuPDF at most once; title detection, heading
+    # detection and section building all read the cached span records.
+    # Used as a context manager, it closes the MuPDF document on every path.
+    # With prefilter, pages that cannot hold a heading are left unparsed when
+    # the caller allows it (see parse_page_spans). It is ignored with
+    # document-wide font statistics, whose body size comes from other pages.
+    def __init__(self, doc, metrics=None, font_statistics=None, prefilter=False):
+        self.doc = doc
+        self.metrics = metrics
+        self.font_statistics = font_statistics
+        self.prefilter = prefilter and font_statistics is None
+        self._pages = {}
+
+    def __len__(self):
+        return len(self.doc)
+
+    def page(self, page_index, prefilter=False):
+        # prefilter: the caller has no use for the spans of a page without
+        # heading candidates, so an empty prefiltered page will do.
+        parsed = self._pages.get(page_index)
+        if parsed is None or (parsed.prefiltered and not prefilter):
+            prefilter = prefilter and self.prefilter
+            with stage_timer(self.metrics, "span_building"):
+                parsed = parse_page_spans(self.doc[page_index], page_index, self.metrics, prefilter)
+            self._pages[page_index] = parsed
+            if self.metrics is not None:
+                self.metrics.count("pages")
+                self.metrics.count("spans", len(parsed.spans))
+                if parsed.prefiltered:
+                    self.metrics.count("prefiltered_pages")
+        return parsed
+
+    def release(self, page_index):
+        # Streaming extractors drop a page's spans as soon as they are used.
+        self._pages.pop(page_index, None)
+
+    def close(self):
+        self._pages.clear()
+        self.doc.close()
+        MUPDF_STORE_LIMIT.after_document()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def as_parsed_document(doc):
+    if isinstance(doc, ParsedDocument):
+        return doc
+    return ParsedDocument(doc)
+
+def has_heading_candidates(blocks, page_height):
+    # Cheap tier of parse_page_spans: the body size of classify_page_spans,
+    # computed from the raw span sizes. is_heading needs a span larger than
+    # the body size, so a page without one yields no heading whatever its
+    # text, and its Span records are never needed for the outline.
+    sizes = Counter([
+        span.get("size", 0)
+        for block in blocks for line in block.get("lines", ()) for span in line["spans"]
+        if 50 < span["bbox"][1] < page_height - 50
+    ])
+    if not sizes:
+        return False
+    body_size = sizes.most_common(1)[0][0]
+    return any(size > body_size for size in sizes)
+
+def parse_page_spans(page, page_index, metrics=None, prefilter=False):
+    # With prefilter, a page that has_heading_candidates rejects comes back
+    # empty and marked prefiltered. MuPDF's lighter text modes are no help
+    # for the first tier: html rounds sizes to 0.1pt and reports baselines
+    # instead of span boxes, so only the dict gives an exact answer.
+    parsed = ParsedPage(page.rect.height)
+    with stage_timer(metrics, "get_text"):
+        blocks = page.get_text("dict", flags=TEXT_EXTRACTION_FLAGS)["blocks"]
+
+    if prefilter:
+        with stage_timer(metrics, "prefilter"):
+            if not has_heading_candidates(blocks, parsed.height):
+                parsed.prefiltered = True
+                return parsed
 
     for block in blocks:
         if "lines" not in block:
@@ -108,25 +414,34 @@ def extract_spans_from_page(doc, page_index):
             avg_width = total_width / span_count if span_count else 100
 
             for span in spans:
-                if is_header_or_footer_block(span, page_height):
-                    continue
+                bbox = span["bbox"]
+                parsed.add(Span(
+                    span["text"].strip(),
+                    span.get("size", 0),
+                    bbox[1],
+                    bbox[2] - bbox[0],
+                    page_index + 1,
+                    span_count,
+                    avg_width
+                ))
 
-                span["text"] = span["text"].strip()
-                span["font_size"] = span.get("size", 0)
-                span["y"] = span["bbox"][1]
-                span["page"] = page_index + 1
-                span["span_count_on_line"] = span_count
-                span["avg_span_width"] = avg_width
-                font_sizes.append(span["font_size"])
-                spans_list.append(span)
+    return parsed
 
+def extract_spans_from_page(doc, page_index, prefilter=False):
+    page = as_parsed_document(doc).page(page_index, prefilter)
+    spans_list = [span for span in page.spans if not is_header_or_footer_block(span, page.height)]
+    font_sizes = [span.font_size for span in spans_list]
     return spans_list, font_sizes
 
 def map_font_sizes_to_levels(font_sizes):
     if not font_sizes:
         return {}, 0
-    most_common_font = Counter(font_sizes).most_common(1)[0][0]
-    sorted_sizes = sorted(set(font_sizes), reverse=True)
+    return map_size_histogram_to_levels(Counter(font_sizes))
+
+def map_size_histogram_to_levels(histogram):
+    # histogram: Counter of font size -> number of spans (non-empty)
+    most_common_font = histogram.most_common(1)[0][0]
+    sorted_sizes = sorted(histogram, reverse=True)
     heading_sizes = [s for s in sorted_sizes if s > most_common_font + 0.3]
 
     heading_map = {}
@@ -139,64 +454,1272 @@ def map_font_sizes_to_levels(font_sizes):
 
     return heading_map, most_common_font
 
-def extract_outline_from_doc(doc):
-    headings = []
-    doc_title = extract_title_from_first_page(doc)
+class FontStatistics:
+    # Document-wide font-size histogram, used instead of each page's own
+    # statistics when enabled. It is opt-in because a document-wide body size
+    # changes which spans count as headings, so outlines can differ from the
+    # per-page default. The histogram (span counts per size rounded to 0.1pt)
+    # is seeded from up to sample_pages evenly spaced pages and refined with
+    # every page classified afterwards, so sparse pages (a title page, a
+    # figure with a caption) no longer decide their own body size.
+    def __init__(self, sample_pages=8):
+        self.sample_pages = sample_pages
+        self.histogram = Counter()
+        self._pages_seen = set()
+        self._seeded = False
+        self._levels = None
 
-    for page_index in range(len(doc)):
-        page = doc[page_index]
-        page_height = page.rect.height
+    def seed(self, doc):
+        self._seeded = True
+        page_count = len(doc)
+        for i in range(min(page_count, self.sample_pages)):
+            page_index = i * page_count // min(page_count, self.sample_pages)
+            # The sampled pages stay cached in doc until they are classified
+            self.add_page(page_index, extract_spans_from_page(doc, page_index)[1])
+
+    def add_page(self, page_index, font_sizes):
+        if page_index in self._pages_seen:
+            return
+        self._pages_seen.add(page_index)
+        if font_sizes:
+            self.histogram.update(round(size, 1) for size in font_sizes)
+            self._levels = None
+
+    def page_levels(self, doc, page_index, font_sizes):
+        # Same result shape as map_font_sizes_to_levels(font_sizes): a map
+        # from the page's exact sizes to levels, and the body size. Callers
+        # compare exact sizes against the body size, so it is the largest
+        # exact size on the page that rounds to the histogram's body size
+        # (body text stored as 10.04pt must not pass a 10.0pt threshold).
+        if not self._seeded:
+            self.seed(doc)
+        self.add_page(page_index, font_sizes)
+        if not self.histogram:
+            return {}, 0
+        if self._levels is None:
+            self._levels = map_size_histogram_to_levels(self.histogram)
+        rounded_map, body_size = self._levels
+        heading_map = {}
+        page_body_size = body_size
+        for size in set(font_sizes):
+            rounded = round(size, 1)
+            level = rounded_map.get(rounded)
+            if level:
+                heading_map[size] = level
+            elif rounded == body_size and size > page_body_size:
+                page_body_size = size
+        return heading_map, page_body_size
 
-        spans, font_sizes = extract_spans_from_page(doc, page_index)
-        heading_level_map, base_font_size = map_font_sizes_to_levels(font_sizes)
+def page_font_levels(doc, page_index, font_sizes):
+    # Size -> level map and body size of a page: from the page itself, or from
+    # the document's FontStatistics when the ParsedDocument carries one.
+    if doc.font_statistics is None:
+        return map_font_sizes_to_levels(font_sizes)
+    return doc.font_statistics.page_levels(doc, page_index, font_sizes)
 
-        for span in spans:
-            if not is_heading(span, base_font_size, page_height):
+def classify_page_spans(doc, page_index, prefilter=False):
+    # Returns the body spans of a page (header/footer bands removed), a parallel
+    # list of is_heading flags, and the page's size -> level map and body size.
+    # With prefilter, a page without heading candidates may return no spans.
+    doc = as_parsed_document(doc)
+    page = doc.page(page_index, prefilter)
+    with stage_timer(doc.metrics, "heading_classification"):
+        if np is None or not page.spans:
+            spans, font_sizes = extract_spans_from_page(doc, page_index, prefilter)
+            with stage_timer(doc.metrics, "font_size_mapping"):
+                heading_level_map, base_font_size = page_font_levels(doc, page_index, font_sizes)
+            flags = [is_heading(span, base_font_size, page.height) for span in spans]
+            return spans, flags, heading_level_map, base_font_size
+
+        # Same tests as is_header_or_footer_block and is_heading, evaluated over
+        # whole columns; only the few spans that survive the numeric filters get
+        # the per-span text checks.
+        sizes = np.frombuffer(page.sizes)
+        ys = np.frombuffer(page.ys)
+        body = (ys > 50) & (ys < page.height - 50)
+        body_index = np.flatnonzero(body)
+        spans = [page.spans[i] for i in body_index.tolist()]
+        with stage_timer(doc.metrics, "font_size_mapping"):
+            heading_level_map, base_font_size = page_font_levels(doc, page_index, sizes[body_index].tolist())
+
+        candidates = (
+            body
+            & (sizes > base_font_size)
+            & (np.frombuffer(page.span_counts) <= 6)
+            & (np.frombuffer(page.avg_widths) >= 40)
+        )
+        heading = np.zeros(len(page.spans), dtype=bool)
+        for i in np.flatnonzero(candidates).tolist():
+            heading[i] = is_heading_text(page.spans[i].text.strip())
+        return spans, heading[body_index].tolist(), heading_level_map, base_font_size
+
+def iter_outline_from_doc(doc, doc_title=None, pages=None):
+    # Yields headings page by page; only one page's spans are alive at a time.
+    # pages restricts the walk to a range of page indexes (one shard of the
+    # document); pages are classified independently, and doc_title is only
+    # consulted on the first page. Pages without headings may be prefiltered.
+    doc = as_parsed_document(doc)
+    if doc_title is None:
+        doc_title = extract_title_from_first_page(doc)
+
+    for page_index in range(len(doc)) if pages is None else pages:
+        spans, flags, heading_level_map, _ = classify_page_spans(doc, page_index, prefilter=True)
+
+        for span, heading in zip(spans, flags):
+            if not heading:
                 continue
-            if span["page"] == 1 and span["text"].strip() in doc_title:
+            if span.page == 1 and span.text.strip() in doc_title:
                 continue
 
-            text = span["text"]
-            size = span["font_size"]
+            text = span.text
+            size = span.font_size
             level = classify_heading_level(text)
 
             if not level and size in heading_level_map:
                 level = heading_level_map[size]
 
             if level:
-                headings.append({
+                if doc.metrics is not None:
+                    doc.metrics.count("headings")
+                yield {
                     "level": level,
                     "text": text,
-                    "page": span["page"]
-                })
+                    "page": span.page
+                }
+
+        doc.release(page_index)
+
+def extract_outline_from_doc(doc, doc_title=None):
+    return list(iter_outline_from_doc(doc, doc_title))
+
+# Bump whenever the extraction heuristics change: cached results are keyed on
+# it, so entries written by an older extractor are never served again.
+EXTRACTOR_VERSION = "1"
+
+def file_digest(pdf_path):
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+SHARED_MEMORY_DIR = "/dev/shm"
+
+class SharedMemoryBudget:
+    # Docker gives /dev/shm 64 MB by default, and filling a segment past the
+    # tmpfs's free space kills the process with SIGBUS instead of raising. A
+    # segment is only created when the free space, minus the bytes other
+    # threads are still copying in, can hold it.
+    def __init__(self, directory=SHARED_MEMORY_DIR):
+        self.directory = directory
+        self.reserved = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def reserve(self, size):
+        # Yields whether size bytes fit; they stay reserved until the block ends
+        with self._lock:
+            try:
+                stat = os.statvfs(self.directory)
+            except OSError:
+                fits = True  # no tmpfs view of the segments (see DocumentSource.open)
+            else:
+                fits = stat.f_bavail * stat.f_frsize - self.reserved >= size
+            if fits:
+                self.reserved += size
+        try:
+            yield fits
+        finally:
+            if fits:
+                with self._lock:
+                    self.reserved -= size
+
+SHARED_MEMORY_BUDGET = SharedMemoryBudget()
+
+class DocumentSource:
+    # Where a PDF's bytes come from: a file path, an in-memory bytes object or
+    # a POSIX shared-memory segment filled by a parent process. PyMuPDF only
+    # accepts a filename or `bytes` (an mmap or memoryview stream is rejected),
+    # so the zero-copy routes go through the filesystem: MuPDF reads a path
+    # itself in small chunks, and a shared-memory segment is opened through
+    # its /dev/shm file, so every worker maps the same tmpfs pages instead of
+    # receiving a pickled copy of the whole PDF.
+    __slots__ = ("name", "path", "data", "shm_name", "size")
+
+    def __init__(self, name, path=None, data=None, shm_name=None, size=0):
+        self.name = name
+        self.path = path
+        self.data = data
+        self.shm_name = shm_name
+        self.size = size
+
+    @classmethod
+    def from_path(cls, path):
+        return cls(os.path.basename(path), path=path, size=os.path.getsize(path))
+
+    @classmethod
+    def from_bytes(cls, data, name):
+        return cls(name, data=data, size=len(data))
+
+    @classmethod
+    def to_shared_memory(cls, path):
+        # Like read_into_shared_memory, but falls back to the path itself
+        size = os.path.getsize(path)
+        with SHARED_MEMORY_BUDGET.reserve(size) as fits:
+            if not fits:
+                return cls.from_path(path), None
+            with open(path, "rb") as f:
+                return cls._fill_shared_memory(f, size, os.path.basename(path))
+
+    @classmethod
+    def read_into_shared_memory(cls, stream, size, name):
+        # Reads `size` bytes of a binary stream (a file, a request body) straight
+        # into a new segment, with no intermediate bytes object. Returns the
+        # source and the SharedMemory handle; the caller owns the segment and
+        # must close() and unlink() it. When /dev/shm cannot hold the bytes
+        # (see SharedMemoryBudget), they are read into a bytes source instead
+        # and the handle is None.
+        with SHARED_MEMORY_BUDGET.reserve(size) as fits:
+            if fits:
+                return cls._fill_shared_memory(stream, size, name)
+        data = stream.read(size)
+        if len(data) < size:
+            raise EOFError(f"{name}: expected {size} bytes, got {len(data)}")
+        return cls.from_bytes(data, name), None
+
+    @classmethod
+    def _fill_shared_memory(cls, stream, size, name):
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            view = shm.buf[:size]
+            try:
+                filled = 0
+                while filled < size:
+                    with view[filled:] as rest:
+                        read = stream.readinto(rest)
+                    if not read:
+                        raise EOFError(f"{name}: expected {size} bytes, got {filled}")
+                    filled += read
+            finally:
+                view.release()
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        return cls(name, shm_name=shm.name, size=size), shm
+
+    def open(self):
+        if self.path is not None:
+            return fitz.open(self.path)
+        if self.data is not None:
+            return fitz.open(stream=self.data, filetype="pdf")
+        shm_path = self._shm_path()
+        if shm_path is not None:
+            return fitz.open(shm_path, filetype="pdf")
+        # No tmpfs view of the segment on this platform: fall back to a copy
+        shm = shared_memory.SharedMemory(name=self.shm_name)
+        try:
+            return fitz.open(stream=bytes(shm.buf[:self.size]), filetype="pdf")
+        finally:
+            shm.close()
+
+    def digest(self):
+        if self.path is not None:
+            return file_digest(self.path)
+        if self.data is not None:
+            return hashlib.sha256(self.data).hexdigest()
+        shm_path = self._shm_path()
+        if shm_path is not None:
+            return file_digest(shm_path)
+        shm = shared_memory.SharedMemory(name=self.shm_name)
+        view = shm.buf[:self.size]
+        try:
+            return hashlib.sha256(view).hexdigest()
+        finally:
+            view.release()
+            shm.close()
+
+    def _shm_path(self):
+        shm_path = os.path.join(SHARED_MEMORY_DIR, self.shm_name.lstrip("/"))
+        return shm_path if os.path.exists(shm_path) else None
+
+def as_document_source(source):
+    if isinstance(source, DocumentSource):
+        return source
+    return DocumentSource.from_path(source)
+
+class ResultCache:
+    # On-disk cache of extraction results keyed by the SHA-256 of the PDF bytes
+    # and EXTRACTOR_VERSION. Entries are JSON files; once their total size goes
+    # past max_bytes the least recently used ones (oldest mtime) are evicted.
+    def __init__(self, cache_dir, max_bytes=256 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._remove_stale_versions()
+
+    def key_for(self, digest, salt=""):
+        if salt:
+            digest = hashlib.sha256(f"{salt}\0{digest}".encode("utf-8")).hexdigest()
+        return f"{digest}-v{EXTRACTOR_VERSION}"
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._entry_path(key)
+        # Unique per process and thread: service requests share one process
+        partial_path = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(partial_path, path)
+        self._evict()
+
+    def clear(self):
+        for entry in self._entries():
+            self._remove(entry[2])
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove_stale_versions(self):
+        suffix = f"-v{EXTRACTOR_VERSION}.json"
+        for _, _, path in self._entries():
+            if not path.endswith(suffix):
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # another worker evicted it first
+
+def write_outline_json(f, title, headings):
+    # Writes {"title": ..., "outline": [...]} as headings arrive, producing the
+    # same bytes as json.dump(result, f, indent=4, ensure_ascii=False).
+    f.write('{\n    "title": ' + json.dumps(title, ensure_ascii=False) + ',\n    "outline": [')
+    empty = True
+    for heading in headings:
+        f.write("\n        " if empty else ",\n        ")
+        f.write(json.dumps(heading, indent=4, ensure_ascii=False).replace("\n", "\n        "))
+        empty = False
+    f.write("]\n}" if empty else "\n    ]\n}")
+
+def outline_json_name(filename):
+    return filename.replace(".pdf", ".json")
+
+def process_pdf_file(source, output_dir, cache=None, metrics=None, document_font_stats=False, prefilter=False):
+    # `source` is a path or a DocumentSource (in-memory or shared-memory input);
+    # `metrics`, a StageMetrics, collects per-stage timings and counters;
+    # document_font_stats switches heading sizes to a document-wide FontStatistics;
+    # prefilter skips building the spans of pages that cannot hold a heading.
+    source = as_document_source(source)
+    filename = source.name
+    cached = None
+    if cache is not None:
+        cache_key = cache.key_for(source.digest(), salt="font-stats" if document_font_stats else "")
+        cached = cache.get(cache_key)
+
+    if cached is not None:
+        if metrics is not None:
+            metrics.count("cache_hits")
+        return write_outline_file(output_dir, filename, cached["title"], cached["outline"], metrics)
+
+    with stage_timer(metrics, "open"):
+        doc = ParsedDocument(source.open(), metrics, FontStatistics() if document_font_stats else None,
+                             prefilter)
+    # Headings are streamed into the JSON, so the document stays open until it is written
+    with doc:
+        with stage_timer(metrics, "title"):
+            title = extract_title_from_first_page(doc)
+        outline = iter_outline_from_doc(doc, doc_title=title)
+        if cache is not None:
+            outline = list(outline)
+            cache.put(cache_key, {"title": title, "outline": outline})
+        return write_outline_file(output_dir, filename, title, outline, metrics)
+
+def write_outline_file(output_dir, filename, title, outline, metrics=None):
+    # The outline is streamed into a temporary file so a document that fails
+    # half-way never leaves a truncated JSON behind.
+    output_file_path = os.path.join(output_dir, outline_json_name(filename))
+    partial_path = output_file_path + ".partial"
+    try:
+        # Headings are classified while the JSON is written; their stages are
+        # nested, so json_write only keeps the serialisation time.
+        with stage_timer(metrics, "json_write"):
+            with open(partial_path, "w", encoding="utf-8") as f:
+                write_outline_json(f, title, outline)
+            os.replace(partial_path, output_file_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    return output_file_path
+
+def _process_pdf_job(job):
+    # Runs inside a pool worker: a corrupt PDF is reported back instead of
+    # raising, so it cannot take the rest of the batch down with it.
+    # Cache counters live in the worker's copy of the cache, so the hit is
+    # reported back alongside the result.
+    full_path, output_dir, cache, collect_metrics, profile_dir, document_font_stats, prefilter = job
+    hits_before = cache.hits if cache is not None else 0
+    metrics = StageMetrics(os.path.basename(full_path)) if collect_metrics else None
+    try:
+        if profile_dir:
+            run_profiled(os.path.join(profile_dir, metrics.name), process_pdf_file,
+                         full_path, output_dir, cache, metrics, document_font_stats, prefilter)
+        else:
+            process_pdf_file(full_path, output_dir, cache=cache, metrics=metrics,
+                             document_font_stats=document_font_stats, prefilter=prefilter)
+        error = None
+    except Exception as e:
+        error = str(e)
+    cache_hit = cache is not None and cache.hits > hits_before
+    report = None
+    if metrics is not None:
+        report = metrics.as_dict()
+        report["peak_rss_mb"] = peak_rss_mb()
+    return full_path, error, cache_hit, report
+
+def page_shards(page_count, shard_pages):
+    # Consecutive (first page, end page) index ranges of at most shard_pages pages
+    return [(first, min(first + shard_pages, page_count)) for first in range(0, page_count, shard_pages)]
+
+def _outline_shard_job(job):
+    # Runs inside a pool worker: opens the document itself and classifies one
+    # page range. Only the shard holding the first page detects the title.
+    # Returns (first page, title or None, headings, error, metrics report).
+    source, first_page, end_page, collect_metrics, prefilter = job
+    metrics = StageMetrics(f"{source.name}[{first_page + 1}-{end_page}]") if collect_metrics else None
+    title, outline, error = None, None, None
+    try:
+        with stage_timer(metrics, "open"):
+            doc = ParsedDocument(source.open(), metrics, prefilter=prefilter)
+        with doc:
+            if first_page == 0:
+                with stage_timer(metrics, "title"):
+                    title = extract_title_from_first_page(doc)
+            outline = list(iter_outline_from_doc(doc, doc_title=title or "", pages=range(first_page, end_page)))
+    except Exception as e:
+        error = str(e)
+    report = None
+    if metrics is not None:
+        report = metrics.as_dict()
+        report["peak_rss_mb"] = peak_rss_mb()
+    return first_page, title, outline, error, report
+
+# Cost model of the batch scheduler, in pages: opening a document costs about
+# as much as classifying this many pages, and a page takes about this long.
+# Only the predicted makespan depends on the rate; the order does not.
+OPEN_COST_PAGES = 2
+ESTIMATED_SECONDS_PER_PAGE = 0.005
+# Outliers are never split into ranges shorter than this
+MIN_SHARD_PAGES = 32
+
+def read_page_count(path):
+    # Page count from the page tree alone (no text extraction), or None when
+    # the file does not open; its job then reports the error.
+    try:
+        with fitz.open(path) as doc:
+            return len(doc)
+    except Exception:
+        return None
+
+def plan_pdf_tasks(jobs, workers, shard_pages, cache, collect_metrics, document_font_stats):
+    # Longest-processing-time-first plan of a parallel batch: a list of
+    # (cost in pages, kind, path, job), most expensive first, where kind is
+    # "pdf" for a _process_pdf_job and "shard" for an _outline_shard_job.
+    # Outliers (documents longer than shard_pages, by default longer than an
+    # even share of the batch per worker) are split into page ranges, unless
+    # the cache already has them or they use document_font_stats.
+    page_counts = {job[0]: read_page_count(job[0]) for job in jobs}
+    if shard_pages <= 0:
+        total_pages = sum(count or 0 for count in page_counts.values())
+        shard_pages = max(MIN_SHARD_PAGES, -(-total_pages // (2 * workers)))
+        outlier_pages = total_pages / workers
+    else:
+        outlier_pages = shard_pages
+
+    tasks = []
+    for job in jobs:
+        full_path, prefilter = job[0], job[-1]
+        page_count = page_counts[full_path] or 0
+        if (page_count > outlier_pages and page_count > shard_pages and not document_font_stats
+                and (cache is None or cache.get(cache.key_for(file_digest(full_path))) is None)):
+            source = DocumentSource.from_path(full_path)
+            for first, end in page_shards(page_count, shard_pages):
+                tasks.append((end - first + OPEN_COST_PAGES, "shard", full_path,
+                              (source, first, end, collect_metrics, prefilter)))
+        else:
+            tasks.append((page_count + OPEN_COST_PAGES, "pdf", full_path, job))
+    # Stable, so equal costs keep the folder order
+    tasks.sort(key=lambda task: -task[0])
+    return tasks
+
+def predicted_makespan(costs, workers):
+    # Busiest worker's load when every free worker takes the next task in
+    # order, which is how the pool hands out LPT-ordered tasks one at a time
+    loads = [0] * workers
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+def _run_pdf_task(task):
+    # Also reports the CPU seconds the task took: unlike its wall time, that
+    # does not grow when more workers than cores share the machine.
+    _, kind, full_path, job = task
+    cpu_start = time.process_time()
+    result = _process_pdf_job(job) if kind == "pdf" else _outline_shard_job(job)
+    return kind, full_path, result, time.process_time() - cpu_start
+
+def _write_sharded_outline(full_path, output_dir, cache, shard_results, collect_metrics):
+    # Merges the shards of one document in page order and writes its JSON in
+    # the parent; returns the same tuple as _process_pdf_job.
+    shard_results = sorted(shard_results, key=lambda result: result[0])
+    error = next((error for _, _, _, error, _ in shard_results if error), None)
+    metrics = StageMetrics(os.path.basename(full_path)) if collect_metrics else None
+    if error is None:
+        title = shard_results[0][1]
+        outline = [heading for _, _, headings, _, _ in shard_results for heading in headings]
+        try:
+            if cache is not None:
+                cache.put(cache.key_for(file_digest(full_path)), {"title": title, "outline": outline})
+            write_outline_file(output_dir, os.path.basename(full_path), title, outline, metrics)
+        except Exception as e:
+            error = str(e)
+    report = None
+    if metrics is not None:
+        for _, _, _, _, shard_report in shard_results:
+            metrics.merge(shard_report)
+        metrics.count("shards", len(shard_results))
+        report = metrics.as_dict()
+        report["peak_rss_mb"] = max(shard_report["peak_rss_mb"] for *_, shard_report in shard_results)
+    return full_path, error, False, report
+
+def _lost_pdf_task(task, collect_metrics):
+    # The result _run_pdf_task would have returned for a task whose worker died
+    _, kind, full_path, job = task
+    error = "worker process died (crash or out of memory)"
+    report = None
+    if collect_metrics:
+        report = StageMetrics(os.path.basename(full_path)).as_dict()
+        report["peak_rss_mb"] = 0.0
+    if kind == "pdf":
+        return kind, full_path, (full_path, error, False, report), 0.0
+    return kind, full_path, (job[1], None, None, error, report), 0.0
+
+def _run_measured(measure_rss, function, *args):
+    # Runs in a RecyclingPool worker: the result plus the worker's RSS after it
+    # (None unless measure_rss, i.e. the pool has a max_worker_rss_mb)
+    return function(*args), current_rss_mb() if measure_rss else None
+
+# Set in RecyclingPool workers: (task id, pid) goes there when a task starts
+_TASKS_STARTED = None
+
+def _init_pool_worker(mupdf_store_mb, tasks_started):
+    global _TASKS_STARTED
+    _TASKS_STARTED = tasks_started
+    limit_mupdf_store(mupdf_store_mb)
+
+def _run_tracked(task_id, measure_rss, function, *args):
+    _TASKS_STARTED.put((task_id, os.getpid()))
+    return _run_measured(measure_rss, function, *args)
+
+# A task counts as lost once the process that started it has been gone this
+# long without a result (a worker leaving after max_tasks_per_worker tasks
+# sends its last result just before it exits)
+LOST_TASK_GRACE_SECONDS = 2.0
+
+class RecyclingPool:
+    # A multiprocessing.Pool that is replaced by fresh processes as soon as a
+    # worker reports more than max_worker_rss_mb of resident memory after a
+    # task (0 = never); max_tasks_per_worker still recycles single workers.
+    # The retired pool gets no new tasks, finishes the ones it holds and exits
+    # in the background, so no result is lost. Workers apply mupdf_store_mb
+    # (see MuPDFStoreLimit) to the documents they open. A pool whose worker
+    # died mid-task (a segfault, the OOM killer) is replaced as well, since
+    # multiprocessing.Pool never completes that task (see imap_unordered).
+    def __init__(self, workers, max_tasks_per_worker=50, max_worker_rss_mb=0, mupdf_store_mb=0):
+        self.workers = workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_worker_rss_mb = max_worker_rss_mb
+        self.mupdf_store_mb = mupdf_store_mb
+        self.recycled = 0
+        self.lost = 0
+        self._lock = threading.Lock()
+        self._retired = []
+        self._broken = []
+        self._tasks_started = multiprocessing.SimpleQueue()
+        self._pool = self._new_pool()
+
+    def _new_pool(self):
+        return multiprocessing.Pool(processes=self.workers, maxtasksperchild=self.max_tasks_per_worker,
+                                    initializer=_init_pool_worker,
+                                    initargs=(self.mupdf_store_mb, self._tasks_started))
+
+    def _check(self, pool, rss_mb):
+        if rss_mb is None or rss_mb <= self.max_worker_rss_mb:
+            return
+        with self._lock:
+            if pool is not self._pool:
+                return  # already retired by another task of the same pool
+            self._pool = self._new_pool()
+            self._retired.append(pool)
+            self.recycled += 1
+        pool.close()
+        threading.Thread(target=self._join_retired, args=(pool,), daemon=True).start()
+
+    def _join_retired(self, pool):
+        pool.join()
+        with self._lock:
+            self._retired.remove(pool)
+
+    def apply(self, function, args=(), timeout=None):
+        # Raises multiprocessing.TimeoutError after timeout seconds: a task
+        # whose worker is killed (e.g. by the OOM killer) never completes
+        with self._lock:
+            pool = self._pool
+        result, rss_mb = pool.apply_async(_run_measured, (self.max_worker_rss_mb > 0, function, *args)).get(timeout)
+        self._check(pool, rss_mb)
+        return result
+
+    def apply_async(self, function, args, callback, error_callback):
+        # Callbacks run on a result thread of the pool, as with Pool.apply_async
+        with self._lock:
+            pool = self._pool
+
+        def done(measured):
+            result, rss_mb = measured
+            self._check(pool, rss_mb)
+            callback(result)
+
+        pool.apply_async(_run_measured, (self.max_worker_rss_mb > 0, function, *args), callback=done, error_callback=error_callback)
+
+    def imap_unordered(self, function, iterable, lost):
+        # Like Pool.imap_unordered with chunks of one, except that a task is
+        # only handed out when a worker frees up, so after a recycle the rest
+        # of the tasks go to the fresh pool. The order of the tasks is kept.
+        # A task whose worker died yields lost(task) instead of a result; its
+        # pool gets no more tasks and is terminated once its others are done.
+        finished = queue.SimpleQueue()
+        tasks = iter(iterable)
+        task_ids = itertools.count()
+        pending = {}  # task id -> (task, pool)
+        running = {}  # task id -> pid of the worker that started it
+        gone = {}  # task id -> when its worker was first seen gone
+        last_check = time.monotonic()
+
+        def submit(count):
+            for task in itertools.islice(tasks, count):
+                task_id = next(task_ids)
+                pending[task_id] = (task, self._submit_tracked(task_id, function, task, finished))
+
+        submit(self.workers)
+        while pending:
+            try:
+                task_id, ok, outcome = finished.get(timeout=LOST_TASK_GRACE_SECONDS / 2)
+            except queue.Empty:
+                task_id = None
+            if task_id in pending:
+                del pending[task_id]
+                if not ok:
+                    raise outcome
+                submit(1)
+                yield outcome
+            if time.monotonic() - last_check < LOST_TASK_GRACE_SECONDS / 2:
+                continue
+            last_check = time.monotonic()
+            for task_id in self._lost_tasks(pending, running, gone):
+                task, pool = pending.pop(task_id)
+                self._retire_broken(pool)
+                submit(1)
+                yield lost(task)
+            self._terminate_idle_broken(pending)
+
+    def _submit_tracked(self, task_id, function, task, finished):
+        with self._lock:
+            pool = self._pool
+
+        def done(measured):
+            result, rss_mb = measured
+            self._check(pool, rss_mb)
+            finished.put((task_id, True, result))
+
+        pool.apply_async(_run_tracked, (task_id, self.max_worker_rss_mb > 0, function, task), callback=done,
+                         error_callback=lambda error: finished.put((task_id, False, error)))
+        return pool
+
+    def _lost_tasks(self, pending, running, gone):
+        # Pending tasks whose worker has been gone for LOST_TASK_GRACE_SECONDS
+        while not self._tasks_started.empty():
+            task_id, pid = self._tasks_started.get()
+            running[task_id] = pid
+        alive = {process.pid for process in multiprocessing.active_children()}
+        now = time.monotonic()
+        lost = []
+        for task_id, pid in list(running.items()):
+            if task_id not in pending:
+                del running[task_id]
+                gone.pop(task_id, None)
+            elif pid not in alive and now - gone.setdefault(task_id, now) >= LOST_TASK_GRACE_SECONDS:
+                del running[task_id]
+                del gone[task_id]
+                lost.append(task_id)
+        return lost
+
+    def _retire_broken(self, pool):
+        # The lost task stays in the pool's cache, so Pool.join would never
+        # return: the pool is terminated instead of joined
+        with self._lock:
+            self.lost += 1
+            if pool is self._pool:
+                self._pool = self._new_pool()
+            if pool not in self._broken:
+                self._broken.append(pool)
+
+    def _terminate_idle_broken(self, pending):
+        with self._lock:
+            idle = [pool for pool in self._broken if all(owner is not pool for _, owner in pending.values())]
+            self._broken = [pool for pool in self._broken if pool not in idle]
+        for pool in idle:
+            pool.terminate()
 
-    return headings
+    def close(self, timeout=None):
+        # Waits for every task, also those still running in retired pools.
+        # After timeout seconds the pools are terminated instead: a task whose
+        # worker was killed never completes, and Pool.join would wait for it.
+        with self._lock:
+            pools = self._retired + [self._pool]
+            broken, self._broken = self._broken, []
+        for pool in broken:
+            pool.terminate()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for pool in pools:
+            pool.close()
+            joiner = threading.Thread(target=pool.join, daemon=True)
+            joiner.start()
+            joiner.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if joiner.is_alive():
+                pool.terminate()
 
-def process_pdf_folder(input_dir, output_dir):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            pools = self._retired + [self._pool] + self._broken
+        for pool in pools:
+            pool.terminate()
+        return False
+
+def process_pdf_folder(input_dir, output_dir, workers=1, max_tasks_per_worker=50, cache=None,
+                       metrics_path=None, profile_slowest=0, filenames=None, document_font_stats=False,
+                       shard_pages=0, prefilter=False, max_worker_rss_mb=1024, mupdf_store_mb=0):
+    # metrics_path: write per-document stage timings and counters there as JSON.
+    # profile_slowest: also keep cProfile/tracemalloc dumps of that many of the
+    # slowest documents in <output_dir>/profiles.
+    # filenames: process only these PDFs of input_dir (incremental runs).
+    # document_font_stats: see FontStatistics (opt-in, may change outlines).
+    # prefilter: see parse_page_spans (opt-in, same outlines).
+    # With several workers, files are dispatched longest first (see
+    # plan_pdf_tasks) and outliers are split into page ranges of shard_pages
+    # pages (0 = sized from the batch) that workers classify in parallel.
+    # Pages are classified independently, so the merged outline is the same;
+    # shards are not profiled, and documents using document_font_stats are
+    # never split because their heading sizes depend on every page seen before.
+    # Workers are recycled after max_tasks_per_worker tasks or once one holds
+    # more than max_worker_rss_mb (see RecyclingPool); every process empties
+    # MuPDF's store between documents per mupdf_store_mb (see MuPDFStoreLimit).
+    # Returns the (path, error, cache_hit, metrics report) of every PDF.
     start_time = time.time()
-    for filename in os.listdir(input_dir):
+    profile_dir = None
+    if profile_slowest > 0:
+        profile_dir = os.path.join(output_dir, "profiles")
+        os.makedirs(profile_dir, exist_ok=True)
+    collect_metrics = metrics_path is not None or profile_dir is not None
+    jobs = [
+        (os.path.join(input_dir, filename), output_dir, cache, collect_metrics, profile_dir, document_font_stats,
+         prefilter)
+        for filename in (os.listdir(input_dir) if filenames is None else filenames)
+        if filename.lower().endswith(".pdf")
+    ]
+
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+
+    tasks = []
+    if workers > 1 and jobs:
+        tasks = plan_pdf_tasks(jobs, workers, shard_pages, cache, collect_metrics, document_font_stats)
+    workers = min(workers, len(tasks) or len(jobs))
+
+    limit_mupdf_store(mupdf_store_mb)
+    if workers > 1:
+        # Each worker opens its own PDFs and writes the JSON as soon as the file
+        # is done; recycled workers keep the heap of a long-lived process from
+        # growing without bound.
+        shard_counts = Counter(full_path for _, kind, full_path, _ in tasks if kind == "shard")
+        shard_results = defaultdict(list)
+        results = []
+        cpu_seconds = 0.0
+        with RecyclingPool(workers, max_tasks_per_worker, max_worker_rss_mb, mupdf_store_mb) as pool:
+            dispatch_time = time.perf_counter()
+            lost = functools.partial(_lost_pdf_task, collect_metrics=collect_metrics)
+            for kind, full_path, result, task_cpu_seconds in pool.imap_unordered(_run_pdf_task, tasks, lost):
+                cpu_seconds += task_cpu_seconds
+                if kind == "pdf":
+                    results.append(result)
+                    continue
+                shard_results[full_path].append(result)
+                if len(shard_results[full_path]) == shard_counts[full_path]:
+                    results.append(_write_sharded_outline(full_path, output_dir, cache,
+                                                          shard_results.pop(full_path), collect_metrics))
+            makespan = time.perf_counter() - dispatch_time
+        print_makespan([cost for cost, *_ in tasks], workers, makespan, cpu_seconds)
+        if pool.recycled:
+            print(f"♻️ Worker pool recycled {pool.recycled} times (a worker exceeded {max_worker_rss_mb} MB)")
+        if pool.lost:
+            print(f"💥 {pool.lost} tasks lost to dead worker processes; their pools were replaced")
+    else:
+        results = list(map(_process_pdf_job, jobs))
+
+    for path, error, _, _ in results:
+        if error:
+            print(f"❌ Error processing {os.path.basename(path)}: {error}")
+
+    if cache is not None:
+        hits = sum(1 for _, _, cache_hit, _ in results if cache_hit)
+        print(f"📦 Cache: {hits} hits, {len(results) - hits} misses")
+
+    if collect_metrics:
+        documents = [report for _, _, _, report in results]
+        if profile_dir is not None:
+            keep_slowest_profiles(profile_dir, documents, profile_slowest)
+        if metrics_path is not None:
+            write_metrics_json(metrics_path, time.time() - start_time, documents)
+            print(f"📊 Metrics written to {metrics_path}")
+
+    print(f"✅ Done in {time.time() - start_time:.2f} seconds")
+    return results
+
+def print_makespan(costs, workers, makespan, cpu_seconds):
+    # Predicted (cost model) against actual makespan, then the makespan the
+    # measured CPU time per page unit predicts for other worker counts, each
+    # worker on its own core, for sizing the worker fleet
+    predicted = predicted_makespan(costs, workers)
+    print(f"⏱️ Makespan with {workers} workers: predicted {predicted * ESTIMATED_SECONDS_PER_PAGE:.2f} s, "
+          f"actual {makespan:.2f} s ({len(costs)} tasks, {sum(costs)} page units, "
+          f"busiest worker {predicted / sum(costs):.0%} of them)")
+    seconds_per_unit = cpu_seconds / sum(costs)
+    print(f"⏱️ Measured {seconds_per_unit * 1000:.2f} ms CPU per page unit; predicted makespan by workers: " + ", ".join(
+        f"{count}: {predicted_makespan(costs, count) * seconds_per_unit:.2f} s" for count in (1, 2, 4, 8, 16, 32)))
+
+def verify_prefilter(input_dir):
+    # Extracts the outline of every PDF of input_dir on the full path and with
+    # the prefilter of parse_page_spans, and reports the documents where the
+    # two differ. Returns their filenames.
+    mismatches = []
+    pages = prefiltered = 0
+    for filename in sorted(os.listdir(input_dir)):
         if not filename.lower().endswith(".pdf"):
             continue
+        outlines = []
+        for prefilter in (False, True):
+            metrics = StageMetrics(filename)
+            try:
+                pdf = fitz.open(os.path.join(input_dir, filename))
+                with ParsedDocument(pdf, metrics, prefilter=prefilter) as doc:
+                    title = extract_title_from_first_page(doc)
+                    outlines.append((title, list(iter_outline_from_doc(doc, title))))
+            except Exception as e:
+                outlines.append(str(e))
+        pages += metrics.counters["pages"]
+        prefiltered += metrics.counters["prefiltered_pages"]
+        if outlines[0] != outlines[1]:
+            mismatches.append(filename)
+            print(f"❌ Prefilter changes the outline of {filename}")
+    print(f"🔎 Prefilter skipped {prefiltered} of {pages} pages; "
+          f"{len(mismatches)} of the outlines differ from the full path")
+    return mismatches
+
+class FolderManifest:
+    # What an incremental run already produced: for every PDF of the input
+    # folder its mtime, size and SHA-256 plus the outline it was turned into
+    # (or the error it failed with). Files whose stat is unchanged are never
+    # opened again, so a pass over a large, mostly processed folder costs one
+    # directory scan. Written atomically after every pass that changed it.
+    def __init__(self, path, variant=""):
+        # variant names the extraction options; outlines made with others are stale
+        self.path = path
+        self.variant = variant
+        self.files = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Outlines from an older extractor are stale: start over
+        if data.get("extractor_version") == EXTRACTOR_VERSION and data.get("variant", "") == variant:
+            self.files = data.get("files", {})
+
+    def save(self):
+        partial_path = self.path + ".partial"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            json.dump({"extractor_version": EXTRACTOR_VERSION, "variant": self.variant, "files": self.files}, f)
+        os.replace(partial_path, self.path)
+
+def _remove_outline(output_dir, output):
+    if output and os.path.exists(os.path.join(output_dir, output)):
+        os.remove(os.path.join(output_dir, output))
+
+def sync_pdf_folder(input_dir, output_dir, manifest, **folder_options):
+    # One incremental pass: outlines for new or modified PDFs, outputs of
+    # removed PDFs deleted. folder_options go to process_pdf_folder.
+    # Returns (processed, removed) counts.
+    current = {}
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(".pdf") and entry.is_file():
+                stat = entry.stat()
+                current[entry.name] = (stat.st_mtime_ns, stat.st_size)
+
+    changed = []
+    dirty = False
+    for filename, (mtime_ns, size) in sorted(current.items()):
+        known = manifest.files.get(filename)
+        if known is not None and known["mtime_ns"] == mtime_ns and known["size"] == size:
+            continue
+        digest = file_digest(os.path.join(input_dir, filename))
+        if known is not None and known["sha256"] == digest:
+            # Touched or copied over with the same bytes: nothing to redo
+            known["mtime_ns"] = mtime_ns
+            dirty = True
+            continue
+        changed.append((filename, mtime_ns, size, digest))
+
+    removed = [filename for filename in manifest.files if filename not in current]
+    for filename in removed:
+        _remove_outline(output_dir, manifest.files.pop(filename).get("output"))
+
+    if changed:
+        results = process_pdf_folder(input_dir, output_dir, filenames=[filename for filename, *_ in changed],
+                                     **folder_options)
+        errors = {os.path.basename(path): error for path, error, _, _ in results}
+        for filename, mtime_ns, size, digest in changed:
+            # A failed file is not retried until it changes again
+            error = errors.get(filename)
+            if error and filename in manifest.files:
+                # The outline of the previous version no longer matches the PDF
+                _remove_outline(output_dir, manifest.files[filename].get("output"))
+            manifest.files[filename] = {
+                "mtime_ns": mtime_ns,
+                "size": size,
+                "sha256": digest,
+                "output": None if error else outline_json_name(filename),
+                "error": error,
+            }
 
-        full_path = os.path.join(input_dir, filename)
-        doc = fitz.open(full_path)
+    if changed or removed or dirty:
+        manifest.save()
+    return len(changed), len(removed)
 
+def watch_pdf_folder(input_dir, output_dir, manifest_path, poll_interval=2.0, once=False, **folder_options):
+    # Polls input_dir (no inotify in the standard library, and polling also
+    # works on bind mounts and network volumes) and syncs it on every pass.
+    manifest = FolderManifest(manifest_path, "font-stats" if folder_options.get("document_font_stats") else "")
+    while True:
+        processed, removed = sync_pdf_folder(input_dir, output_dir, manifest, **folder_options)
+        if processed or removed or once:
+            print(f"🔄 {processed} new or changed, {removed} removed, {len(manifest.files)} tracked")
+        if once:
+            return
+        time.sleep(poll_interval)
+
+class ServiceBusy(Exception):
+    pass
+
+class RequestLimiter:
+    # Backpressure for the HTTP service: at most max_pending requests are
+    # admitted (uploading, waiting or running) and at most max_active run at
+    # once. Requests beyond max_pending are refused right away instead of
+    # queueing without bound. An upload is read under admitted() only, so a
+    # slow client never holds one of the active() slots.
+    def __init__(self, max_active, max_pending):
+        self._admitted = threading.BoundedSemaphore(max(max_pending, max_active))
+        self._active = threading.BoundedSemaphore(max_active)
+
+    @contextlib.contextmanager
+    def admitted(self):
+        if not self._admitted.acquire(blocking=False):
+            raise ServiceBusy()
+        try:
+            yield
+        finally:
+            self._admitted.release()
+
+    def active(self):
+        return self._active
+
+def _outline_from_source(source):
+    # Runs in a warm service worker; the PDF arrives as a shared-memory DocumentSource.
+    with ParsedDocument(source.open()) as doc:
         title = extract_title_from_first_page(doc)
-        outline = extract_outline_from_doc(doc)
+        return title, extract_outline_from_doc(doc, doc_title=title)
 
-        result = {
-            "title": title,
-            "outline": outline
-        }
+class OutlineService:
+    # The long-running form of process_pdf_folder: a process pool forked once
+    # (fitz and numpy already imported) serves every request, and the result
+    # cache, when given, is shared by all of them. A PDF not done within
+    # request_timeout seconds fails the request instead of holding its slot.
+    def __init__(self, workers, max_pending=32, max_tasks_per_worker=50, cache=None, max_worker_rss_mb=1024,
+                 mupdf_store_mb=0, request_timeout=300):
+        self.workers = workers
+        self.cache = cache
+        self.request_timeout = request_timeout
+        self.limiter = RequestLimiter(workers, max_pending)
+        self.pool = RecyclingPool(workers, max_tasks_per_worker, max_worker_rss_mb, mupdf_store_mb)
 
-        output_file_path = os.path.join(output_dir, filename.replace(".pdf", ".json"))
-        with open(output_file_path, "w", encoding="utf-8") as f:
-            json.dump(result, f, indent=4, ensure_ascii=False)
+    def outline_json(self, source):
+        # Same bytes as the JSON process_pdf_folder writes for this PDF
+        cache_key = None
+        cached = None
+        if self.cache is not None:
+            cache_key = self.cache.key_for(source.digest())
+            cached = self.cache.get(cache_key)
 
-    print(f"✅ Done in {time.time() - start_time:.2f} seconds")
+        if cached is not None:
+            title, outline = cached["title"], cached["outline"]
+        else:
+            title, outline = self.pool.apply(_outline_from_source, (source,), self.request_timeout or None)
+            if cache_key is not None:
+                self.cache.put(cache_key, {"title": title, "outline": outline})
+
+        buffer = io.StringIO()
+        write_outline_json(buffer, title, outline)
+        return buffer.getvalue().encode("utf-8")
+
+    def close(self):
+        self.pool.close(self.request_timeout or None)
+
+class OutlineRequestHandler(BaseHTTPRequestHandler):
+    # POST /outline with the PDF as the request body returns its outline JSON;
+    # GET /health reports the pool size. `service` is set by serve().
+    service = None
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, {"status": "ok", "workers": self.service.workers})
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != "/outline":
+            self._send_json(404, {"error": "not found"})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self._send_json(411, {"error": "Content-Length required"})
+            return
+        if not re.fullmatch(r"[0-9]+", length):
+            # Where the body ends is unknown, so the connection is not reused
+            self.close_connection = True
+            self._send_json(400, {"error": f"invalid Content-Length: {length!r}"})
+            return
+        length = int(length)
+
+        try:
+            # Admission happens before the body is read, so a busy service
+            # refuses uploads without buffering them. The body is read before
+            # an extraction slot is taken, so slow uploads only queue.
+            with self.service.limiter.admitted():
+                source, shm = DocumentSource.read_into_shared_memory(self.rfile, length, "upload.pdf")
+                try:
+                    with self.service.limiter.active():
+                        body = self.service.outline_json(source)
+                finally:
+                    if shm is not None:
+                        shm.close()
+                        shm.unlink()
+        except ServiceBusy:
+            self._discard_body(length)
+            self._send_json(503, {"error": "too many pending requests"}, {"Retry-After": "1"})
+            return
+        except multiprocessing.TimeoutError:
+            self._send_json(504, {"error": f"no outline within {self.service.request_timeout} seconds"})
+            return
+        except Exception as e:
+            self._send_json(422, {"error": str(e)})
+            return
+        self._send(200, body)
+
+    def _discard_body(self, length):
+        # Clients only read the 503 once their upload is accepted
+        while length > 0:
+            chunk = self.rfile.read(min(length, 1 << 16))
+            if not chunk:
+                break
+            length -= len(chunk)
+
+    def _send_json(self, status, payload, headers=None):
+        self._send(status, json.dumps(payload).encode("utf-8"), headers)
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(host, port, workers=1, max_pending=32, max_tasks_per_worker=50, cache=None, max_worker_rss_mb=1024,
+          mupdf_store_mb=0, request_timeout=300):
+    service = OutlineService(workers, max_pending=max_pending, max_tasks_per_worker=max_tasks_per_worker,
+                             cache=cache, max_worker_rss_mb=max_worker_rss_mb, mupdf_store_mb=mupdf_store_mb,
+                             request_timeout=request_timeout)
+    handler = type("BoundOutlineRequestHandler", (OutlineRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    # docker stop sends SIGTERM: shut down as cleanly as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"🚀 Serving outlines on http://{host}:{port}/outline with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
 
 if __name__ == "__main__":
-    input_path = "/app/input"
-    output_path = "/app/output"
-    os.makedirs(output_path, exist_ok=True)
-    process_pdf_folder(input_path, output_path)
+    parser = argparse.ArgumentParser(description="Extract title and H1-H3 outline from every PDF in a folder")
+    parser.add_argument("--input", default="/app/input", help="folder with the input PDFs")
+    parser.add_argument("--output", default="/app/output", help="folder the JSON outlines are written to")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (0 = one per CPU core)")
+    parser.add_argument("--max-tasks-per-worker", type=int, default=50,
+                        help="PDFs a worker handles before it is replaced by a fresh process")
+    parser.add_argument("--max-worker-rss-mb", type=int, default=1024,
+                        help="replace the worker processes once one of them holds more resident memory "
+                             "than this after a PDF (0 = never)")
+    parser.add_argument("--mupdf-store-mb", type=int, default=0,
+                        help="empty MuPDF's object and glyph caches between PDFs once a process has grown "
+                             "this much since they were last emptied (0 = after every PDF)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="reuse outlines of unchanged PDFs from this on-disk cache")
+    parser.add_argument("--cache-max-mb", type=int, default=256,
+                        help="evict least recently used cache entries beyond this size")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="drop every cached result before processing")
+    parser.add_argument("--metrics", action="store_true",
+                        help="write per-document stage timings and counters to <output>/metrics.json")
+    parser.add_argument("--profile-slowest", type=int, default=0, metavar="N",
+                        help="keep cProfile and tracemalloc dumps of the N slowest PDFs in <output>/profiles")
+    parser.add_argument("--document-font-stats", action="store_true",
+                        help="derive body and heading sizes from a document-wide, sampled font-size "
+                             "histogram instead of per page (may change outlines)")
+    parser.add_argument("--shard-pages", type=int, default=0, metavar="N",
+                        help="with several workers, split PDFs longer than N pages into N-page ranges "
+                             "processed in parallel (0 = split only outliers, sized from the batch)")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="skip building the spans of pages whose sizes rule out any heading "
+                             "(same outlines; see --verify-prefilter)")
+    parser.add_argument("--verify-prefilter", action="store_true",
+                        help="extract every PDF with and without skipping pages that cannot hold a "
+                             "heading, report outlines that differ, and exit")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process PDFs that are new or changed since the last run, "
+                             "and delete outlines of removed PDFs")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep polling the input folder and process arrivals incrementally")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="seconds between scans of the input folder in --watch mode")
+    parser.add_argument("--manifest", default=None,
+                        help="manifest of processed PDFs (default: <output>/.outline_manifest.json)")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as an HTTP service (POST a PDF to /outline) instead of a batch")
+    parser.add_argument("--host", default="127.0.0.1", help="address the service listens on")
+    parser.add_argument("--port", type=int, default=8080, help="port the service listens on")
+    parser.add_argument("--max-pending", type=int, default=32,
+                        help="requests admitted at once; the service answers 503 beyond this")
+    parser.add_argument("--request-timeout", type=float, default=300,
+                        help="seconds the service waits for a PDF's outline before answering 504 (0 = forever)")
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, max_bytes=args.cache_max_mb * 2**20)
+        if args.clear_cache:
+            cache.clear()
+
+    if args.verify_prefilter:
+        raise SystemExit(1 if verify_prefilter(args.input) else 0)
+
+    if args.serve:
+        workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+        serve(args.host, args.port, workers=workers, max_pending=args.max_pending,
+              max_tasks_per_worker=args.max_tasks_per_worker, cache=cache,
+              max_worker_rss_mb=args.max_worker_rss_mb, mupdf_store_mb=args.mupdf_store_mb,
+              request_timeout=args.request_timeout)
+        raise SystemExit(0)
+
+    os.makedirs(args.output, exist_ok=True)
+    if args.incremental or args.watch:
+        manifest_path = args.manifest or os.path.join(args.output, ".outline_manifest.json")
+        try:
+            watch_pdf_folder(args.input, args.output, manifest_path, poll_interval=args.poll_interval,
+                             once=not args.watch, workers=args.workers,
+                             max_tasks_per_worker=args.max_tasks_per_worker, cache=cache,
+                             document_font_stats=args.document_font_stats, shard_pages=args.shard_pages,
+                             prefilter=args.prefilter, max_worker_rss_mb=args.max_worker_rss_mb,
+                             mupdf_store_mb=args.mupdf_store_mb)
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit(0)
+
+    metrics_path = os.path.join(args.output, "metrics.json") if args.metrics else None
+    process_pdf_folder(args.input, args.output, workers=args.workers,
+                       max_tasks_per_worker=args.max_tasks_per_worker, cache=cache,
+                       metrics_path=metrics_path, profile_slowest=args.profile_slowest,
+                       document_font_stats=args.document_font_stats, shard_pages=args.shard_pages,
+                       prefilter=args.prefilter, max_worker_rss_mb=args.max_worker_rss_mb,
+                       mupdf_store_mb=args.mupdf_store_mb)
@@ -2,21 +2,65 @@ import fitz
 import os
 import json
 import time
+import argparse
+import contextlib
+import cProfile
+import hashlib
+import heapq
+import itertools
 import string
+import threading
 import re
-from collections import defaultdict, Counter
+import signal
+import sys
+import tracemalloc
+from array import array
+from multiprocessing import shared_memory
+from collections import defaultdict, deque, Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
+try:
+    import resource
+except ImportError:  # Windows: peak memory is reported as 0.0
+    resource = None
+
+try:
+    import numpy as np
+except ImportError:  # classify_page_spans falls back to per-span is_heading calls
+    np = None
+
+# Text-only extraction: image blocks (and their raw bytes) are never built.
+# Ligatures and whitespace are still preserved because dropping them changes
+# the span text and therefore the extracted titles and headings.
+TEXT_EXTRACTION_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+class Span:
+    # One text span, kept as a slotted record instead of the MuPDF span dict:
+    # only the fields the title and heading heuristics read are stored.
+    __slots__ = ("text", "font_size", "y", "width", "page", "span_count_on_line", "avg_span_width")
+
+    def __init__(self, text, font_size, y, width, page, span_count_on_line, avg_span_width):
+        self.text = text
+        self.font_size = font_size
+        self.y = y
+        self.width = width
+        self.page = page
+        self.span_count_on_line = span_count_on_line
+        self.avg_span_width = avg_span_width
+
 def is_header_or_footer_block(span, page_height, header_limit=50, footer_limit=50):
-    y_position = span["bbox"][1]
+    y_position = span.y
     return y_position <= header_limit or y_position >= (page_height - footer_limit)
 
 def is_title_candidate(span, page_number):
     if page_number != 1:
         return False
 
-    text = span['text'].strip()
+    text = span.text.strip()
     if not text or not any(c.isalpha() for c in text):
         return False
     if sum(1 for c in text if c in string.punctuation) / len(text) > 0.6:
@@ -29,24 +73,17 @@ def is_title_candidate(span, page_number):
     if text.isupper() and len(text.split()) <= 5:
         return False
 
-    bbox_width = span['bbox'][2] - span['bbox'][0]
-    font_size = span.get("size", 0)
-    return font_size >= 10 and bbox_width >= 100
+    return span.font_size >= 10 and span.width >= 100
 
 def extract_title_from_first_page(doc):
     potential_titles = []
-    first_page = doc[0]
-    for block in first_page.get_text("dict")["blocks"]:
-        if "lines" not in block:
-            continue
-        for line in block["lines"]:
-            for span in line["spans"]:
-                if is_title_candidate(span, 1):
-                    potential_titles.append({
-                        "text": span["text"].strip(),
-                        "y": span["bbox"][1],
-                        "font_size": span["size"]
-                    })
+    for span in as_parsed_document(doc).page(0).spans:
+        if is_title_candidate(span, 1):
+            potential_titles.append({
+                "text": span.text.strip(),
+                "y": span.y,
+                "font_size": span.font_size
+            })
 
     if not potential_titles:
         return ""
@@ -65,17 +102,21 @@ def extract_title_from_first_page(doc):
 
     return " ".join(combined_title)
 
-def is_heading(span, body_font_size, page_height):
-    text = span["text"].strip()
+def is_heading_text(text):
     if not text or len(text) < 3:
         return False
     if text.count(" ") > 10 and not text.endswith(":"):
         return False
-    if span.get("span_count_on_line", 1) > 6:
+    return True
+
+def is_heading(span, body_font_size, page_height):
+    if not is_heading_text(span.text.strip()):
+        return False
+    if span.span_count_on_line > 6:
         return False
-    if span.get("avg_span_width", 100) < 40:
+    if span.avg_span_width < 40:
         return False
-    if span["font_size"] <= body_font_size:
+    if span.font_size <= body_font_size:
         return False
     if is_header_or_footer_block(span, page_height):
         return False
@@ -92,12 +133,275 @@ def classify_heading_level(text):
         return "H4"
     return None
 
-def extract_spans_from_page(doc, page_index):
-    page = doc[page_index]
-    page_height = page.rect.height
-    blocks = page.get_text("dict")["blocks"]
-    spans_list = []
-    font_sizes = []
+class StageMetrics:
+    # Wall-clock seconds per pipeline stage plus counters for one document or
+    # collection. Stage timers nest, and each stage keeps only its exclusive
+    # time, so the stage totals add up to the measured time.
+    __slots__ = ("name", "stages", "counters", "_active")
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.counters = Counter()
+        self._active = None
+
+    def stage(self, stage):
+        return _StageTimer(self, stage)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def merge(self, report):
+        # Adds the stages and counters of an as_dict() report, e.g. of one
+        # page-range shard of this document processed by another worker.
+        for stage, seconds in report["stages"].items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.counters.update(report["counters"])
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "seconds": round(sum(self.stages.values()), 6),
+            "stages": {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+class _StageTimer:
+    __slots__ = ("metrics", "stage", "parent", "nested", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.parent = self.metrics._active
+        self.metrics._active = self
+        self.nested = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        metrics = self.metrics
+        metrics._active = self.parent
+        if self.parent is not None:
+            self.parent.nested += elapsed
+        metrics.stages[self.stage] = metrics.stages.get(self.stage, 0.0) + elapsed - self.nested
+        return False
+
+_NO_STAGE = contextlib.nullcontext()
+
+def stage_timer(metrics, stage):
+    # Hot paths call this unconditionally: without metrics it is a shared no-op.
+    return _NO_STAGE if metrics is None else metrics.stage(stage)
+
+def peak_rss_mb(children=False):
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return round(usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 1024), 1)
+
+def current_rss_mb():
+    # Resident memory right now (Linux), which unlike ru_maxrss also goes down.
+    # Without /proc the peak stands in for it; None when neither is available.
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except OSError:
+        return peak_rss_mb() if resource is not None else None
+
+class MuPDFStoreLimit:
+    # MuPDF keeps fonts, images and parsed objects of every document in one
+    # process-wide store that only evicts at its compiled-in 256 MB, and
+    # PyMuPDF can neither lower that limit nor report the store's size. The
+    # cap is enforced between documents instead: once the process has grown
+    # more than max_mb since the store was last emptied, the store and the
+    # glyph cache are emptied (0 = after every document). Documents never
+    # share entries, so nothing a later document could use is lost.
+    __slots__ = ("max_mb", "baseline_mb")
+
+    def __init__(self, max_mb=0):
+        self.max_mb = max_mb
+        self.baseline_mb = None
+
+    def after_document(self):
+        # Memory is only measured under a limit; when it cannot be measured
+        # the stores are emptied as with no limit
+        if self.max_mb > 0:
+            rss_mb = current_rss_mb()
+            if rss_mb is not None and self.baseline_mb is not None and rss_mb - self.baseline_mb <= self.max_mb:
+                return
+        fitz.TOOLS.store_shrink(100)
+        fitz.TOOLS.glyph_cache_empty()
+        if self.max_mb > 0:
+            self.baseline_mb = current_rss_mb()
+
+MUPDF_STORE_LIMIT = MuPDFStoreLimit()
+
+def limit_mupdf_store(max_mb):
+    # Sets this process's MuPDFStoreLimit; also the initializer of worker pools
+    MUPDF_STORE_LIMIT.max_mb = max_mb
+
+def run_profiled(profile_base, function, *args):
+    # Runs function(*args) under cProfile and tracemalloc, leaving
+    # <profile_base>.prof (for pstats/snakeviz) and <profile_base>.tracemalloc.txt.
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        return function(*args)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(profile_base + ".prof")
+        with open(profile_base + ".tracemalloc.txt", "w", encoding="utf-8") as f:
+            f.write(f"peak traced memory: {peak / 2**20:.2f} MB\n")
+            for stat in snapshot.statistics("lineno")[:25]:
+                f.write(f"{stat}\n")
+
+def keep_slowest_profiles(profile_dir, documents, keep):
+    # Every document is profiled; only the `keep` slowest dumps are left behind.
+    ranked = sorted(documents, key=lambda entry: entry["seconds"], reverse=True)
+    for entry in ranked[keep:]:
+        for suffix in (".prof", ".tracemalloc.txt"):
+            path = os.path.join(profile_dir, entry["name"] + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+def write_metrics_json(path, wall_seconds, documents, collections=()):
+    # documents and collections are StageMetrics.as_dict() entries; worker
+    # processes add their own peak_rss_mb to the documents they handled.
+    stages = Counter()
+    counters = Counter()
+    for entry in list(documents) + list(collections):
+        stages.update(entry["stages"])
+        counters.update(entry["counters"])
+    worker_rss = [entry["peak_rss_mb"] for entry in documents if "peak_rss_mb" in entry]
+    report = {
+        "wall_seconds": round(wall_seconds, 6),
+        "peak_rss_mb": {
+            "main": peak_rss_mb(),
+            "workers": max(worker_rss + [peak_rss_mb(children=True)]),
+        },
+        "stages": {stage: round(seconds, 6) for stage, seconds in sorted(stages.items())},
+        "counters": dict(sorted(counters.items())),
+        "collections": list(collections),
+        "documents": sorted(documents, key=lambda entry: entry["name"]),
+    }
+    if not report["collections"]:
+        del report["collections"]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+class ParsedPage:
+    # The spans of one page plus their numeric fields as flat float columns,
+    # collected while parsing so classify_page_spans can view them as arrays.
+    # prefiltered marks a page whose spans were never built because the cheap
+    # tier of parse_page_spans proved it holds no heading candidate.
+    __slots__ = ("spans", "height", "sizes", "ys", "span_counts", "avg_widths", "prefiltered")
+
+    def __init__(self, height):
+        self.spans = []
+        self.height = height
+        self.prefiltered = False
+        self.sizes = array("d")
+        self.ys = array("d")
+        self.span_counts = array("d")
+        self.avg_widths = array("d")
+
+    def add(self, span):
+        self.spans.append(span)
+        self.sizes.append(span.font_size)
+        self.ys.append(span.y)
+        self.span_counts.append(span.span_count_on_line)
+        self.avg_widths.append(span.avg_span_width)
+
+class ParsedDocument:
+    # Every page is decoded by MuPDF at most once; title detection, heading
+    # detection and section building all read the cached span records.
+    # Used as a context manager, it closes the MuPDF document on every path.
+    # With prefilter, pages that cannot hold a heading are left unparsed when
+    # the caller allows it (see parse_page_spans). It is ignored with
+    # document-wide font statistics, whose body size comes from other pages.
+    def __init__(self, doc, metrics=None, font_statistics=None, prefilter=False):
+        self.doc = doc
+        self.metrics = metrics
+        self.font_statistics = font_statistics
+        self.prefilter = prefilter and font_statistics is None
+        self._pages = {}
+
+    def __len__(self):
+        return len(self.doc)
+
+    def page(self, page_index, prefilter=False):
+        # prefilter: the caller has no use for the spans of a page without
+        # heading candidates, so an empty prefiltered page will do.
+        parsed = self._pages.get(page_index)
+        if parsed is None or (parsed.prefiltered and not prefilter):
+            prefilter = prefilter and self.prefilter
+            with stage_timer(self.metrics, "span_building"):
+                parsed = parse_page_spans(self.doc[page_index], page_index, self.metrics, prefilter)
+            self._pages[page_index] = parsed
+            if self.metrics is not None:
+                self.metrics.count("pages")
+                self.metrics.count("spans", len(parsed.spans))
+                if parsed.prefiltered:
+                    self.metrics.count("prefiltered_pages")
+        return parsed
+
+    def release(self, page_index):
+        # Streaming extractors drop a page's spans as soon as they are used.
+        self._pages.pop(page_index, None)
+
+    def close(self):
+        self._pages.clear()
+        self.doc.close()
+        MUPDF_STORE_LIMIT.after_document()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def as_parsed_document(doc):
+    if isinstance(doc, ParsedDocument):
+        return doc
+    return ParsedDocument(doc)
+
+def has_heading_candidates(blocks, page_height):
+    # Cheap tier of parse_page_spans: the body size of classify_page_spans,
+    # computed from the raw span sizes. is_heading needs a span larger than
+    # the body size, so a page without one yields no heading whatever its
+    # text, and its Span records are never needed for the outline.
+    sizes = Counter([
+        span.get("size", 0)
+        for block in blocks for line in block.get("lines", ()) for span in line["spans"]
+        if 50 < span["bbox"][1] < page_height - 50
+    ])
+    if not sizes:
+        return False
+    body_size = sizes.most_common(1)[0][0]
+    return any(size > body_size for size in sizes)
+
+def parse_page_spans(page, page_index, metrics=None, prefilter=False):
+    # With prefilter, a page that has_heading_candidates rejects comes back
+    # empty and marked prefiltered. MuPDF's lighter text modes are no help
+    # for the first tier: html rounds sizes to 0.1pt and reports baselines
+    # instead of span boxes, so only the dict gives an exact answer.
+    parsed = ParsedPage(page.rect.height)
+    with stage_timer(metrics, "get_text"):
+        blocks = page.get_text("dict", flags=TEXT_EXTRACTION_FLAGS)["blocks"]
+
+    if prefilter:
+        with stage_timer(metrics, "prefilter"):
+            if not has_heading_candidates(blocks, parsed.height):
+                parsed.prefiltered = True
+                return parsed
 
     for block in blocks:
         if "lines" not in block:
@@ -110,25 +414,34 @@ def extract_spans_from_page(doc, page_index):
             avg_width = total_width / span_count if span_count else 100
 
             for span in spans:
-                if is_header_or_footer_block(span, page_height):
-                    continue
+                bbox = span["bbox"]
+                parsed.add(Span(
+                    span["text"].strip(),
+                    span.get("size", 0),
+                    bbox[1],
+                    bbox[2] - bbox[0],
+                    page_index + 1,
+                    span_count,
+                    avg_width
+                ))
 
-                span["text"] = span["text"].strip()
-                span["font_size"] = span.get("size", 0)
-                span["y"] = span["bbox"][1]
-                span["page"] = page_index + 1
-                span["span_count_on_line"] = span_count
-                span["avg_span_width"] = avg_width
-                font_sizes.append(span["font_size"])
-                spans_list.append(span)
+    return parsed
 
+def extract_spans_from_page(doc, page_index, prefilter=False):
+    page = as_parsed_document(doc).page(page_index, prefilter)
+    spans_list = [span for span in page.spans if not is_header_or_footer_block(span, page.height)]
+    font_sizes = [span.font_size for span in spans_list]
     return spans_list, font_sizes
 
 def map_font_sizes_to_levels(font_sizes):
     if not font_sizes:
         return {}, 0
-    most_common_font = Counter(font_sizes).most_common(1)[0][0]
-    sorted_sizes = sorted(set(font_sizes), reverse=True)
+    return map_size_histogram_to_levels(Counter(font_sizes))
+
+def map_size_histogram_to_levels(histogram):
+    # histogram: Counter of font size -> number of spans (non-empty)
+    most_common_font = histogram.most_common(1)[0][0]
+    sorted_sizes = sorted(histogram, reverse=True)
     heading_sizes = [s for s in sorted_sizes if s > most_common_font + 0.3]
 
     heading_map = {}
@@ -141,43 +454,997 @@ def map_font_sizes_to_levels(font_sizes):
 
     return heading_map, most_common_font
 
-def extract_outline_from_doc(doc):
-    headings = []
-    doc_title = extract_title_from_first_page(doc)
+class FontStatistics:
+    # Document-wide font-size histogram, used instead of each page's own
+    # statistics when enabled. It is opt-in because a document-wide body size
+    # changes which spans count as headings, so outlines can differ from the
+    # per-page default. The histogram (span counts per size rounded to 0.1pt)
+    # is seeded from up to sample_pages evenly spaced pages and refined with
+    # every page classified afterwards, so sparse pages (a title page, a
+    # figure with a caption) no longer decide their own body size.
+    def __init__(self, sample_pages=8):
+        self.sample_pages = sample_pages
+        self.histogram = Counter()
+        self._pages_seen = set()
+        self._seeded = False
+        self._levels = None
 
-    for page_index in range(len(doc)):
-        page = doc[page_index]
-        page_height = page.rect.height
+    def seed(self, doc):
+        self._seeded = True
+        page_count = len(doc)
+        for i in range(min(page_count, self.sample_pages)):
+            page_index = i * page_count // min(page_count, self.sample_pages)
+            # The sampled pages stay cached in doc until they are classified
+            self.add_page(page_index, extract_spans_from_page(doc, page_index)[1])
 
-        spans, font_sizes = extract_spans_from_page(doc, page_index)
-        heading_level_map, base_font_size = map_font_sizes_to_levels(font_sizes)
+    def add_page(self, page_index, font_sizes):
+        if page_index in self._pages_seen:
+            return
+        self._pages_seen.add(page_index)
+        if font_sizes:
+            self.histogram.update(round(size, 1) for size in font_sizes)
+            self._levels = None
 
-        for span in spans:
-            if not is_heading(span, base_font_size, page_height):
+    def page_levels(self, doc, page_index, font_sizes):
+        # Same result shape as map_font_sizes_to_levels(font_sizes): a map
+        # from the page's exact sizes to levels, and the body size. Callers
+        # compare exact sizes against the body size, so it is the largest
+        # exact size on the page that rounds to the histogram's body size
+        # (body text stored as 10.04pt must not pass a 10.0pt threshold).
+        if not self._seeded:
+            self.seed(doc)
+        self.add_page(page_index, font_sizes)
+        if not self.histogram:
+            return {}, 0
+        if self._levels is None:
+            self._levels = map_size_histogram_to_levels(self.histogram)
+        rounded_map, body_size = self._levels
+        heading_map = {}
+        page_body_size = body_size
+        for size in set(font_sizes):
+            rounded = round(size, 1)
+            level = rounded_map.get(rounded)
+            if level:
+                heading_map[size] = level
+            elif rounded == body_size and size > page_body_size:
+                page_body_size = size
+        return heading_map, page_body_size
+
+def page_font_levels(doc, page_index, font_sizes):
+    # Size -> level map and body size of a page: from the page itself, or from
+    # the document's FontStatistics when the ParsedDocument carries one.
+    if doc.font_statistics is None:
+        return map_font_sizes_to_levels(font_sizes)
+    return doc.font_statistics.page_levels(doc, page_index, font_sizes)
+
+def classify_page_spans(doc, page_index, prefilter=False):
+    # Returns the body spans of a page (header/footer bands removed), a parallel
+    # list of is_heading flags, and the page's size -> level map and body size.
+    # With prefilter, a page without heading candidates may return no spans.
+    doc = as_parsed_document(doc)
+    page = doc.page(page_index, prefilter)
+    with stage_timer(doc.metrics, "heading_classification"):
+        if np is None or not page.spans:
+            spans, font_sizes = extract_spans_from_page(doc, page_index, prefilter)
+            with stage_timer(doc.metrics, "font_size_mapping"):
+                heading_level_map, base_font_size = page_font_levels(doc, page_index, font_sizes)
+            flags = [is_heading(span, base_font_size, page.height) for span in spans]
+            return spans, flags, heading_level_map, base_font_size
+
+        # Same tests as is_header_or_footer_block and is_heading, evaluated over
+        # whole columns; only the few spans that survive the numeric filters get
+        # the per-span text checks.
+        sizes = np.frombuffer(page.sizes)
+        ys = np.frombuffer(page.ys)
+        body = (ys > 50) & (ys < page.height - 50)
+        body_index = np.flatnonzero(body)
+        spans = [page.spans[i] for i in body_index.tolist()]
+        with stage_timer(doc.metrics, "font_size_mapping"):
+            heading_level_map, base_font_size = page_font_levels(doc, page_index, sizes[body_index].tolist())
+
+        candidates = (
+            body
+            & (sizes > base_font_size)
+            & (np.frombuffer(page.span_counts) <= 6)
+            & (np.frombuffer(page.avg_widths) >= 40)
+        )
+        heading = np.zeros(len(page.spans), dtype=bool)
+        for i in np.flatnonzero(candidates).tolist():
+            heading[i] = is_heading_text(page.spans[i].text.strip())
+        return spans, heading[body_index].tolist(), heading_level_map, base_font_size
+
+def iter_outline_from_doc(doc, doc_title=None):
+    # Yields headings page by page; only one page's spans are alive at a time.
+    doc = as_parsed_document(doc)
+    if doc_title is None:
+        doc_title = extract_title_from_first_page(doc)
+
+    for page_index in range(len(doc)):
+        spans, flags, heading_level_map, _ = classify_page_spans(doc, page_index, prefilter=True)
+
+        for span, heading in zip(spans, flags):
+            if not heading:
                 continue
-            if span["page"] == 1 and span["text"].strip() in doc_title:
+            if span.page == 1 and span.text.strip() in doc_title:
                 continue
 
-            text = span["text"]
-            size = span["font_size"]
+            text = span.text
+            size = span.font_size
             level = classify_heading_level(text)
 
             if not level and size in heading_level_map:
                 level = heading_level_map[size]
 
             if level:
-                headings.append({
+                if doc.metrics is not None:
+                    doc.metrics.count("headings")
+                yield {
                     "level": level,
                     "text": text,
-                    "page": span["page"]
-                })
+                    "page": span.page
+                }
+
+        doc.release(page_index)
+
+def extract_outline_from_doc(doc, doc_title=None):
+    return list(iter_outline_from_doc(doc, doc_title))
+
+# Bump whenever the extraction heuristics or the cached section format change:
+# cached results are keyed on it, so entries written by an older extractor are
+# never served again.
+EXTRACTOR_VERSION = "2"
+
+def file_digest(pdf_path):
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+SHARED_MEMORY_DIR = "/dev/shm"
+
+class SharedMemoryBudget:
+    # Docker gives /dev/shm 64 MB by default, and filling a segment past the
+    # tmpfs's free space kills the process with SIGBUS instead of raising. A
+    # segment is only created when the free space, minus the bytes other
+    # threads are still copying in, can hold it.
+    def __init__(self, directory=SHARED_MEMORY_DIR):
+        self.directory = directory
+        self.reserved = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def reserve(self, size):
+        # Yields whether size bytes fit; they stay reserved until the block ends
+        with self._lock:
+            try:
+                stat = os.statvfs(self.directory)
+            except OSError:
+                fits = True  # no tmpfs view of the segments (see DocumentSource.open)
+            else:
+                fits = stat.f_bavail * stat.f_frsize - self.reserved >= size
+            if fits:
+                self.reserved += size
+        try:
+            yield fits
+        finally:
+            if fits:
+                with self._lock:
+                    self.reserved -= size
+
+SHARED_MEMORY_BUDGET = SharedMemoryBudget()
+
+class DocumentSource:
+    # Where a PDF's bytes come from: a file path, an in-memory bytes object or
+    # a POSIX shared-memory segment filled by a parent process. PyMuPDF only
+    # accepts a filename or `bytes` (an mmap or memoryview stream is rejected),
+    # so the zero-copy routes go through the filesystem: MuPDF reads a path
+    # itself in small chunks, and a shared-memory segment is opened through
+    # its /dev/shm file, so every worker maps the same tmpfs pages instead of
+    # receiving a pickled copy of the whole PDF.
+    __slots__ = ("name", "path", "data", "shm_name", "size")
+
+    def __init__(self, name, path=None, data=None, shm_name=None, size=0):
+        self.name = name
+        self.path = path
+        self.data = data
+        self.shm_name = shm_name
+        self.size = size
+
+    @classmethod
+    def from_path(cls, path):
+        return cls(os.path.basename(path), path=path, size=os.path.getsize(path))
+
+    @classmethod
+    def from_bytes(cls, data, name):
+        return cls(name, data=data, size=len(data))
+
+    @classmethod
+    def to_shared_memory(cls, path):
+        # Like read_into_shared_memory, but falls back to the path itself
+        size = os.path.getsize(path)
+        with SHARED_MEMORY_BUDGET.reserve(size) as fits:
+            if not fits:
+                return cls.from_path(path), None
+            with open(path, "rb") as f:
+                return cls._fill_shared_memory(f, size, os.path.basename(path))
+
+    @classmethod
+    def read_into_shared_memory(cls, stream, size, name):
+        # Reads `size` bytes of a binary stream (a file, a request body) straight
+        # into a new segment, with no intermediate bytes object. Returns the
+        # source and the SharedMemory handle; the caller owns the segment and
+        # must close() and unlink() it. When /dev/shm cannot hold the bytes
+        # (see SharedMemoryBudget), they are read into a bytes source instead
+        # and the handle is None.
+        with SHARED_MEMORY_BUDGET.reserve(size) as fits:
+            if fits:
+                return cls._fill_shared_memory(stream, size, name)
+        data = stream.read(size)
+        if len(data) < size:
+            raise EOFError(f"{name}: expected {size} bytes, got {len(data)}")
+        return cls.from_bytes(data, name), None
+
+    @classmethod
+    def _fill_shared_memory(cls, stream, size, name):
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            view = shm.buf[:size]
+            try:
+                filled = 0
+                while filled < size:
+                    with view[filled:] as rest:
+                        read = stream.readinto(rest)
+                    if not read:
+                        raise EOFError(f"{name}: expected {size} bytes, got {filled}")
+                    filled += read
+            finally:
+                view.release()
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        return cls(name, shm_name=shm.name, size=size), shm
+
+    def open(self):
+        if self.path is not None:
+            return fitz.open(self.path)
+        if self.data is not None:
+            return fitz.open(stream=self.data, filetype="pdf")
+        shm_path = self._shm_path()
+        if shm_path is not None:
+            return fitz.open(shm_path, filetype="pdf")
+        # No tmpfs view of the segment on this platform: fall back to a copy
+        shm = shared_memory.SharedMemory(name=self.shm_name)
+        try:
+            return fitz.open(stream=bytes(shm.buf[:self.size]), filetype="pdf")
+        finally:
+            shm.close()
+
+    def digest(self):
+        if self.path is not None:
+            return file_digest(self.path)
+        if self.data is not None:
+            return hashlib.sha256(self.data).hexdigest()
+        shm_path = self._shm_path()
+        if shm_path is not None:
+            return file_digest(shm_path)
+        shm = shared_memory.SharedMemory(name=self.shm_name)
+        view = shm.buf[:self.size]
+        try:
+            return hashlib.sha256(view).hexdigest()
+        finally:
+            view.release()
+            shm.close()
+
+    def _shm_path(self):
+        shm_path = os.path.join(SHARED_MEMORY_DIR, self.shm_name.lstrip("/"))
+        return shm_path if os.path.exists(shm_path) else None
+
+def as_document_source(source):
+    if isinstance(source, DocumentSource):
+        return source
+    return DocumentSource.from_path(source)
+
+class ResultCache:
+    # On-disk cache of extraction results keyed by the SHA-256 of the PDF bytes
+    # and EXTRACTOR_VERSION. Entries are JSON files; once their total size goes
+    # past max_bytes the least recently used ones (oldest mtime) are evicted.
+    def __init__(self, cache_dir, max_bytes=256 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._remove_stale_versions()
+
+    def key_for(self, digest, salt=""):
+        if salt:
+            digest = hashlib.sha256(f"{salt}\0{digest}".encode("utf-8")).hexdigest()
+        return f"{digest}-v{EXTRACTOR_VERSION}"
 
-    return headings
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        value = self.lookup(key)
+        self.record(value is not None)
+        return value
+
+    def lookup(self, key):
+        # Like get, but leaves the hit/miss counters alone so prefetch threads
+        # can read entries and the consuming thread records the outcome.
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return value
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key, value):
+        path = self._entry_path(key)
+        # Unique per process and thread: service requests share one process
+        partial_path = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(partial_path, path)
+        self._evict()
+
+    def clear(self):
+        for entry in self._entries():
+            self._remove(entry[2])
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove_stale_versions(self):
+        suffix = f"-v{EXTRACTOR_VERSION}.json"
+        for _, _, path in self._entries():
+            if not path.endswith(suffix):
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # another worker evicted it first
+
+class DocumentSections:
+    """Sections of one document whose content lives as offsets into a single text buffer"""
+    
+    __slots__ = ("sections", "text", "bounds", "_lower")
+    
+    # Between sections; a newline is neither cased nor case-ignorable, so it keeps
+    # the final-sigma rule of str.lower from looking across section boundaries
+    SEPARATOR = "\n"
+    
+    def __init__(self, sections, text, bounds):
+        # sections hold every field but "content"; section i's content is
+        # text[bounds[2 * i]:bounds[2 * i + 1]]
+        self.sections = sections
+        self.text = text
+        self.bounds = bounds
+        self._lower = None
+    
+    @classmethod
+    def build(cls, section_parts):
+        """Join (section, content span texts) pairs into one buffer without per-section strings"""
+        sections = []
+        pieces = []
+        bounds = array("q")
+        offset = 0
+        for section, parts in section_parts:
+            if sections:
+                pieces.append(cls.SEPARATOR)
+                offset += len(cls.SEPARATOR)
+            bounds.append(offset)
+            for index, part in enumerate(parts):
+                if index:
+                    pieces.append(" ")
+                    offset += 1
+                pieces.append(part)
+                offset += len(part)
+            bounds.append(offset)
+            sections.append(section)
+        return cls(sections, "".join(pieces), bounds)
+    
+    def __len__(self):
+        return len(self.sections)
+    
+    def __iter__(self):
+        return iter(self.sections)
+    
+    def span(self, index):
+        return self.bounds[2 * index], self.bounds[2 * index + 1]
+    
+    def content(self, index):
+        start, end = self.span(index)
+        return self.text[start:end]
+    
+    def lower_text(self):
+        """The lowercased buffer, or None when lowercasing moves the section offsets"""
+        # str.lower never shortens a character, so an unchanged total length
+        # means every character maps to exactly one and the offsets still hold
+        if self._lower is None:
+            lower = self.text.lower()
+            self._lower = lower if len(lower) == len(self.text) else False
+        return self._lower or None
+    
+    def materialized(self):
+        """Section dicts with each section's content spans joined into a "content" string"""
+        return [dict(section, content=self.content(index)) for index, section in enumerate(self.sections)]
+    
+    def __getstate__(self):
+        # Pickled to and from extraction workers: the lowercased copy is rebuilt on demand
+        return self.sections, self.text, self.bounds
+    
+    def __setstate__(self, state):
+        self.sections, self.text, self.bounds = state
+        self._lower = None
+    
+    def to_json(self, title):
+        return {"title": title, "sections": self.sections, "text": self.text, "bounds": list(self.bounds)}
+    
+    @classmethod
+    def from_json(cls, payload):
+        return cls(payload["sections"], payload["text"], array("q", payload["bounds"]))
+
+class KeywordMatcher:
+    """Scores persona keywords with one regex pass per text, using str.count semantics"""
+    
+    def __init__(self, importance_keywords):
+        # Per-keyword weights: high = 5 in titles / 3 in content, medium = 2 anywhere
+        self.title_weights = defaultdict(int)
+        self.content_weights = defaultdict(int)
+        # Keywords the automaton cannot count exactly: the empty string, and medium
+        # keywords with a space, which can match across the title/content join
+        self.direct_keywords = []
+        
+        for keyword in importance_keywords.get('high', []):
+            keyword = keyword.lower()
+            if not keyword:
+                self.direct_keywords.append((keyword, 5, 3, 0))
+                continue
+            self.title_weights[keyword] += 5
+            self.content_weights[keyword] += 3
+        
+        for keyword in importance_keywords.get('medium', []):
+            keyword = keyword.lower()
+            if not keyword or " " in keyword:
+                self.direct_keywords.append((keyword, 0, 0, 2))
+                continue
+            self.title_weights[keyword] += 2
+            self.content_weights[keyword] += 2
+        
+        keywords = list(self.title_weights)
+        # Every keyword that matches at a position is a prefix of the longest one
+        # matching there, so one match per position is enough to count them all
+        self.prefixes = {k: [p for p in keywords if k.startswith(p)] for k in keywords}
+        self.pattern = re.compile("(?=(" + _keyword_trie_pattern(keywords) + "))") if keywords else None
+    
+    def count(self, text, start=0, end=None):
+        """Return {keyword: text.count(keyword, start, end)} for every keyword present in text"""
+        counts = defaultdict(int)
+        if self.pattern is None:
+            return counts
+        next_free = {}
+        # finditer's endpos bounds the lookahead too, so no match runs past end
+        for match in self.pattern.finditer(text, start, len(text) if end is None else end):
+            start = match.start()
+            for keyword in self.prefixes[match.group(1)]:
+                # str.count only counts non-overlapping occurrences, left to right
+                if start >= next_free.get(keyword, 0):
+                    counts[keyword] += 1
+                    next_free[keyword] = start + len(keyword)
+        return counts
+    
+    def score(self, title, content):
+        """Weighted keyword score of an already lowercased title and content"""
+        return self.score_span(title, content, 0, len(content))
+    
+    def score_span(self, title, text, start, end):
+        """score() with the content given as text[start:end], sliced only for keywords the automaton skips"""
+        score = 0
+        for keyword, matches in self.count(title).items():
+            score += matches * self.title_weights[keyword]
+        for keyword, matches in self.count(text, start, end).items():
+            score += matches * self.content_weights[keyword]
+        if self.direct_keywords:
+            joined = title + " " + text[start:end]
+            for keyword, title_weight, content_weight, text_weight in self.direct_keywords:
+                score += title.count(keyword) * title_weight + text.count(keyword, start, end) * content_weight
+                score += joined.count(keyword) * text_weight
+        return score
+
+def _keyword_trie_pattern(keywords):
+    # A regex shaped like a trie of the keywords: at each position only the
+    # branch for the next character is tried, and optional groups are greedy,
+    # so the longest keyword starting there is the one that matches.
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def pattern(node):
+        branches = [re.escape(char) + pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if "" in node:
+            return "(?:" + "|".join(branches) + ")?"
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+    
+    return pattern(trie)
+
+class TopSectionSelector:
+    """Keeps content only for each document's best sections while documents are scored"""
+    
+    def __init__(self, per_document=15):
+        # Subsection analysis reads the 15 best sections overall, which are always
+        # among their documents' best 15; every other section only needs the
+        # fields the diversity loop looks at, so its content is dropped
+        self.per_document = per_document
+        self._sections = []
+        self._stubs = []
+        self._documents = 0
+    
+    def add_document(self, scored_sections, document=None, position=None):
+        """Offer every scored section of one document, in document order"""
+        # (-score, seq) orders like the stable descending sort by importance; seq is
+        # (document position, section index), unique, so the section and its index
+        # in document are never compared. position defaults to the order documents
+        # are offered in. Without document the sections carry their own content.
+        if position is None:
+            position = self._documents
+        self._documents += 1
+        entries = []
+        for index, section in enumerate(scored_sections):
+            entries.append((-section["importance_score"], (position, index), section, index))
+        entries.sort()
+        self._sections.extend(entry + (document,) for entry in entries[:self.per_document])
+        for negative_score, seq, section, _ in entries[self.per_document:]:
+            stub = {key: section[key] for key in ("document", "section_title", "page_number", "importance_score")}
+            self._stubs.append((negative_score, seq, stub, None, None))
+    
+    def ranked(self):
+        """Yield sections best first; content-less stubs come off a heap only as far as they are read"""
+        # Content of the best sections is materialized from its document buffer
+        # only when the section is actually read
+        self._sections.sort()
+        heapq.heapify(self._stubs)
+        
+        def stubs():
+            while self._stubs:
+                yield heapq.heappop(self._stubs)
+        
+        for _, _, section, index, document in heapq.merge(self._sections, stubs()):
+            if document is not None:
+                section["content"] = document.content(index)
+            yield section
+
+class CollectionBudget:
+    """Wall-clock budget of one collection, with document cost estimates refined as documents finish"""
+    
+    def __init__(self, seconds, reserve_fraction=0.1, seconds_per_page=0.01, seconds_per_mb=0.005):
+        self.seconds = seconds
+        self.deadline = time.perf_counter() + seconds
+        # Held back from extraction for selection, subsection chunking and the output
+        self.reserve = seconds * reserve_fraction
+        # Starting guesses; seconds_per_page becomes the rate measured on this collection
+        self.seconds_per_page = seconds_per_page
+        self.seconds_per_mb = seconds_per_mb
+        self._pages_timed = 0
+        self._seconds_timed = 0.0
+        self.reduced_documents = []
+        self.subsections_skipped = False
+    
+    def remaining(self):
+        return self.deadline - time.perf_counter()
+    
+    def extraction_deadline(self):
+        return self.deadline - self.reserve
+    
+    def estimate(self, page_count, size):
+        """Expected seconds to open and extract a document of page_count pages and size bytes"""
+        return page_count * self.seconds_per_page + size / 2**20 * self.seconds_per_mb
+    
+    def observe(self, pages, seconds):
+        """Refine the per-page rate with a document whose pages took `seconds`"""
+        if pages:
+            self._pages_timed += pages
+            self._seconds_timed += seconds
+            self.seconds_per_page = self._seconds_timed / self._pages_timed
+    
+    def affordable_pages(self, page_count, size):
+        """How many of a document's pages fit in the time left for extraction"""
+        available = self.extraction_deadline() - time.perf_counter() - size / 2**20 * self.seconds_per_mb
+        return min(page_count, max(0, int(available / self.seconds_per_page)))
+    
+    def allows_subsections(self):
+        # The second half of the reserve is kept for writing the output
+        return self.remaining() > self.reserve / 2
+    
+    def reduce(self, filename, page_count, pages_processed):
+        """Record a document extracted from pages_processed of its pages (0 = skipped, page_count None = not opened)"""
+        self.reduced_documents.append({
+            "filename": filename,
+            "pages_processed": pages_processed,
+            "page_count": page_count
+        })
+    
+    def metadata(self):
+        return {
+            "time_budget_seconds": self.seconds,
+            "reduced_documents": self.reduced_documents,
+            "subsection_analysis_skipped": self.subsections_skipped
+        }
+
+def sample_pages(page_count, count):
+    # count evenly spaced page indexes, starting with the first page
+    return [i * page_count // count for i in range(count)]
+
+class TitleDeduplicator:
+    """Index of seen titles for the containment-based duplicate check of the diversity loop"""
+    
+    def __init__(self, gram_size=3):
+        self.gram_size = gram_size
+        self.titles = []
+        self.title_ids = {}
+        # Every q-gram of a seen title -> ids of the seen titles containing it
+        self.grams = defaultdict(set)
+        # First q-gram of a seen title -> ids of the seen titles starting with it
+        self.first_grams = defaultdict(set)
+        # Seen titles too short to have a q-gram are compared directly
+        self.short_titles = []
+    
+    def __len__(self):
+        return len(self.titles)
+    
+    def add(self, title):
+        if title in self.title_ids:
+            return
+        title_id = len(self.titles)
+        self.titles.append(title)
+        self.title_ids[title] = title_id
+        q = self.gram_size
+        if len(title) < q:
+            self.short_titles.append(title)
+            return
+        self.first_grams[title[:q]].add(title_id)
+        for i in range(len(title) - q + 1):
+            self.grams[title[i:i + q]].add(title_id)
+    
+    def overlaps(self, title):
+        """True if title is a substring of a seen title or a seen title is a substring of it"""
+        if title in self.title_ids:
+            return True
+        if any(seen in title or title in seen for seen in self.short_titles):
+            return True
+        q = self.gram_size
+        if len(title) < q:
+            return any(title in seen for seen in self.titles)
+        
+        # title inside a seen title: the seen title holds every q-gram of title,
+        # so intersecting the rarest gram postings first leaves few to verify
+        postings = sorted((self.grams.get(title[i:i + q], ()) for i in range(len(title) - q + 1)), key=len)
+        if postings[0]:
+            candidates = set(postings[0])
+            for ids in postings[1:]:
+                candidates &= ids
+                if not candidates:
+                    break
+            if any(title in self.titles[title_id] for title_id in candidates):
+                return True
+        
+        # A seen title inside title: it must start at one of title's q-grams
+        for i in range(len(title) - q + 1):
+            for title_id in self.first_grams.get(title[i:i + q], ()):
+                if self.titles[title_id] in title:
+                    return True
+        return False
+
+class SectionIndex:
+    """Persistent inverted index of a collection: term -> (section, field, frequency) postings"""
+    
+    def __init__(self, documents=(), document_digests=None):
+        self.documents = list(documents)
+        self.document_digests = dict(document_digests or {})
+        self.sections = []
+        self.postings = defaultdict(list)
+        # Persona-independent ranking, filled on the first query
+        self.base_ranking = None
+        self._term_trigrams = None
+        self._terms_by_piece = {}
+    
+    def add_section(self, section):
+        """Index the title ("t") and content ("c") terms of one section"""
+        section_id = len(self.sections)
+        self.sections.append(section)
+        for field, text in (("t", section.get("section_title", "")), ("c", section.get("content", ""))):
+            for term, frequency in Counter(re.findall(r"\w+", text.lower())).items():
+                self.postings[term].append((section_id, field, frequency))
+        self.base_ranking = None
+        self._term_trigrams = None
+        self._terms_by_piece = {}
+    
+    def candidate_sections(self, keywords):
+        """Ids of the sections that may contain any keyword, or None if every section may"""
+        # Keywords count as substrings, but every word-character run of a keyword
+        # must sit inside one indexed term, so the postings of the terms containing
+        # each run give a superset of the sections the keyword occurs in
+        candidates = set()
+        for keyword in keywords:
+            pieces = re.findall(r"\w+", keyword)
+            if not pieces:
+                return None
+            keyword_sections = None
+            for piece in pieces:
+                piece_sections = {
+                    section_id
+                    for term in self._terms_containing(piece)
+                    for section_id, _, _ in self.postings[term]
+                }
+                keyword_sections = piece_sections if keyword_sections is None else keyword_sections & piece_sections
+                if not keyword_sections:
+                    break
+            candidates |= keyword_sections
+        return candidates
+    
+    def _terms_containing(self, piece):
+        terms = self._terms_by_piece.get(piece)
+        if terms is not None:
+            return terms
+        if len(piece) < 3:
+            terms = [term for term in self.postings if piece in term]
+        else:
+            if self._term_trigrams is None:
+                self._term_trigrams = defaultdict(set)
+                for term in self.postings:
+                    for i in range(len(term) - 2):
+                        self._term_trigrams[term[i:i + 3]].add(term)
+            grams = sorted((self._term_trigrams.get(piece[i:i + 3], set()) for i in range(len(piece) - 2)), key=len)
+            terms = [term for term in set.intersection(*grams) if piece in term]
+        self._terms_by_piece[piece] = terms
+        return terms
+    
+    def save(self, path):
+        """Write the index as JSON"""
+        data = {
+            "extractor_version": EXTRACTOR_VERSION,
+            "documents": self.documents,
+            "document_digests": self.document_digests,
+            "sections": self.sections,
+            "postings": self.postings,
+        }
+        partial_path = path + ".partial"
+        with open(partial_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(partial_path, path)
+    
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save, or None if it came from another extractor version"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get("extractor_version") != EXTRACTOR_VERSION:
+            return None
+        index = cls(data["documents"], data["document_digests"])
+        index.sections = data["sections"]
+        index.postings = defaultdict(list, data["postings"])
+        return index
 
 # Challenge 1B Enhanced Analyzer
+def _extract_sections_from_source(source, filename, collect_metrics=False, profile_dir=None,
+                                  document_font_stats=False, prefilter=False):
+    # Runs in an extraction worker process, where the PDF arrives as a
+    # DocumentSource prefetched by a thread of the parent (a shared-memory
+    # segment), so the worker never touches the input volume and no PDF bytes
+    # are pickled; with workers == 1 it runs inline on a path source.
+    # Returns (sections, title, metrics report or None).
+    metrics = StageMetrics(filename) if collect_metrics or profile_dir else None
+    if profile_dir:
+        sections, title = run_profiled(os.path.join(profile_dir, filename), _extract_sections,
+                                       source, filename, metrics, document_font_stats, prefilter)
+    else:
+        sections, title = _extract_sections(source, filename, metrics, document_font_stats, prefilter)
+    report = None
+    if metrics is not None:
+        report = metrics.as_dict()
+        report["peak_rss_mb"] = peak_rss_mb()
+    return sections, title, report
+
+def _extract_sections(source, filename, metrics, document_font_stats=False, prefilter=False):
+    with stage_timer(metrics, "open"):
+        doc = ParsedDocument(source.open(), metrics, FontStatistics() if document_font_stats else None, prefilter)
+    with doc:
+        sections, title = PersonaDrivenAnalyzer().extract_enhanced_sections_from_doc(doc, filename)
+    if metrics is not None:
+        metrics.count("sections", len(sections))
+    return sections, title
+
+def _read_page_count(source):
+    # Runs in an extraction worker process: the parent's reader threads never
+    # open documents themselves, since PyMuPDF is not thread-safe
+    with source.open() as doc:
+        return len(doc)  # reads the page tree only, no text
+
+def page_shards(page_count, shard_pages):
+    # Consecutive (first page, end page) index ranges of at most shard_pages pages
+    return [(first, min(first + shard_pages, page_count)) for first in range(0, page_count, shard_pages)]
+
+def _extract_section_shard(source, filename, first_page, end_page, collect_metrics=False, prefilter=False):
+    # Runs in an extraction worker process on one page range of a long
+    # document, opening the prefetched source itself. Only the shard holding
+    # the first page detects the title.
+    # Returns (sections, leading introduction, title or None, metrics report or None).
+    metrics = StageMetrics(f"{filename}[{first_page + 1}-{end_page}]") if collect_metrics else None
+    analyzer = PersonaDrivenAnalyzer()
+    with stage_timer(metrics, "open"):
+        doc = ParsedDocument(source.open(), metrics, prefilter=prefilter)
+    with doc:
+        title = None
+        if first_page == 0:
+            with stage_timer(metrics, "title"):
+                title = extract_title_from_first_page(doc)
+        with stage_timer(metrics, "section_building"):
+            sections, leading_introduction = analyzer.extract_section_shard(doc, filename, range(first_page, end_page))
+    report = None
+    if metrics is not None:
+        report = metrics.as_dict()
+        report["peak_rss_mb"] = peak_rss_mb()
+    return sections, leading_introduction, title, report
+
+def _run_measured(measure_rss, function, *args):
+    # Runs in a RecyclingExecutor worker: the result plus the worker's RSS after it
+    # (None unless measure_rss, i.e. the executor has a max_worker_rss_mb)
+    return function(*args), current_rss_mb() if measure_rss else None
+
+class RecyclingExecutor:
+    """ProcessPoolExecutor replaced by fresh processes once a worker outgrows max_worker_rss_mb"""
+    
+    def __init__(self, max_workers, max_worker_rss_mb=0, mupdf_store_mb=0):
+        # Every worker reports its resident memory after a task; above the
+        # threshold (0 = never) new tasks go to a fresh executor while the
+        # retired one finishes the tasks it holds and shuts down in the
+        # background, so no result is lost. Workers apply mupdf_store_mb (see
+        # MuPDFStoreLimit) to the documents they open.
+        self.max_workers = max_workers
+        self.max_worker_rss_mb = max_worker_rss_mb
+        self.mupdf_store_mb = mupdf_store_mb
+        self.recycled = 0
+        self._lock = threading.Lock()
+        self._retired = []
+        self._executor = self._new_executor()
+    
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.max_workers, initializer=limit_mupdf_store,
+                                   initargs=(self.mupdf_store_mb,))
+    
+    def submit(self, function, *args):
+        """Schedule function(*args) and return a Future of its result"""
+        future = Future()
+        # Submitting under the lock keeps a task from reaching an executor
+        # that _check has already shut down
+        with self._lock:
+            executor = self._executor
+            measured = executor.submit(_run_measured, self.max_worker_rss_mb > 0, function, *args)
+        
+        def done(measured):
+            try:
+                result, rss_mb = measured.result()
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            self._check(executor, rss_mb)
+            future.set_result(result)
+        
+        measured.add_done_callback(done)
+        return future
+    
+    def _check(self, executor, rss_mb):
+        """Retire executor if the worker that just finished a task has grown too big"""
+        if rss_mb is None or rss_mb <= self.max_worker_rss_mb:
+            return
+        with self._lock:
+            if executor is not self._executor:
+                return  # already retired by another task of the same executor
+            self._executor = self._new_executor()
+            self._retired.append(executor)
+            self.recycled += 1
+        # Done callbacks run on the executor's own management thread, which
+        # shutdown(wait=True) joins: wait for it from another thread
+        threading.Thread(target=self._shutdown_retired, args=(executor,), daemon=True).start()
+    
+    def _shutdown_retired(self, executor):
+        executor.shutdown()
+        with self._lock:
+            self._retired.remove(executor)
+    
+    def shutdown(self, wait=True):
+        """Shut down the current executor and any retired one still finishing tasks"""
+        with self._lock:
+            executors = self._retired + [self._executor]
+        for executor in executors:
+            executor.shutdown(wait=wait)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        return False
+
 class PersonaDrivenAnalyzer:
-    def __init__(self):
+    def __init__(self, cache=None, workers=1, prefetch=4, collect_metrics=False, profile_dir=None,
+                 document_font_stats=False, shard_pages=0, collection_budget=None, prefilter=False,
+                 max_worker_rss_mb=1024, mupdf_store_mb=0):
+        self.cache = cache
+        # Opt-in document-wide heading sizes (see FontStatistics); part of every cache key
+        self.document_font_stats = document_font_stats
+        # workers > 1 overlaps reading, extraction and scoring (see iter_collection_sections)
+        self.workers = workers
+        self.prefetch = prefetch
+        # With worker processes, documents longer than this many pages are split
+        # into page ranges extracted in parallel (0 = whole documents only)
+        self.shard_pages = shard_pages
+        # Extraction processes are recycled once one holds more than this many
+        # MB after a document (0 = never); see RecyclingExecutor and MuPDFStoreLimit
+        self.max_worker_rss_mb = max_worker_rss_mb
+        self.mupdf_store_mb = mupdf_store_mb
+        # Seconds each collection must finish in (see process_collection_within_budget)
+        self.collection_budget = collection_budget
+        # Opt-in: documents are parsed with prefilter, which skips building the
+        # spans of pages that cannot change the sections (see page_section_parts)
+        self.prefilter = prefilter
+        # Per-document extraction metrics (StageMetrics.as_dict() entries) when enabled;
+        # profile_dir additionally gets a cProfile/tracemalloc dump per extracted PDF
+        self.collect_metrics = collect_metrics or profile_dir is not None
+        self.profile_dir = profile_dir
+        self.document_metrics = []
+        # A long-lived RecyclingExecutor (the HTTP service) replaces the per-collection one
+        self.extractors = None
+        # (content hash, filename) -> sections, shared by every collection in a run
+        self.document_sections = {}
+        self._path_digests = {}
         self.importance_keywords = {}
+        self.keyword_matcher = KeywordMatcher({})
         self.section_patterns = [
             r'^(\d+\.?\s+.+)$',  # Numbered sections
             r'^([A-Z][A-Za-z\s]+:)$',  # Title with colon
@@ -246,91 +1513,348 @@ class PersonaDrivenAnalyzer:
         keywords['medium'].extend([word.lower() for word in job_words if len(word) > 3])
         
         self.importance_keywords = dict(keywords)
+        self.keyword_matcher = KeywordMatcher(self.importance_keywords)
     
     def extract_enhanced_sections_from_doc(self, doc, doc_name):
         """Extract sections using Challenge 1A logic + enhanced text extraction"""
-        # Get title using Challenge 1A
-        title = extract_title_from_first_page(doc)
-        
-        sections = []
+        # Get title using Challenge 1A; pages are decoded once and shared
+        doc = as_parsed_document(doc)
+        with stage_timer(doc.metrics, "title"):
+            title = extract_title_from_first_page(doc)
+        with stage_timer(doc.metrics, "section_building"):
+            sections = DocumentSections.build(self.iter_section_parts(doc, doc_name))
+        return sections, title
+    
+    def iter_section_parts(self, doc, doc_name):
+        """Yield (section, content span texts) page by page, dropping each page's spans once used"""
+        doc = as_parsed_document(doc)
+        sections_emitted = 0
         
         for page_num in range(len(doc)):
-            page = doc[page_num]
-            page_height = page.rect.height
-            spans, font_sizes = extract_spans_from_page(doc, page_num)
-            heading_level_map, base_font_size = map_font_sizes_to_levels(font_sizes)
+            page_sections, introduction = self.page_section_parts(doc, doc_name, page_num, sections_emitted > 0)
+            # Text before a page's first heading only forms a section at the start of the document
+            if introduction and sections_emitted:
+                del page_sections[0]
+            sections_emitted += len(page_sections)
+            yield from page_sections
             
-            current_section = None
-            section_content = []
+            doc.release(page_num)
+    
+    def page_section_parts(self, doc, doc_name, page_num, after_sections=False):
+        """Return one page's (section, content span texts) pairs and whether the first is an introduction"""
+        # Sections never continue across pages; the only state a page takes from
+        # the pages before it is whether its leading text becomes an introduction.
+        # Once sections were found before it (after_sections), a page without
+        # heading candidates yields nothing but that dropped introduction, so
+        # a prefiltering document may skip building its spans.
+        spans, flags, heading_level_map, base_font_size = classify_page_spans(doc, page_num, after_sections)
+        
+        page_sections = []
+        introduction = False
+        current_section = None
+        section_content = []
+        
+        for span, heading in zip(spans, flags):
+            text = span.text.strip()
+            if not text:
+                continue
             
-            for span in spans:
-                text = span["text"].strip()
-                if not text:
-                    continue
+            # Check if this is a heading using Challenge 1A logic
+            if heading:
+                # Save previous section
+                if current_section and section_content:
+                    page_sections.append((current_section, section_content))
                 
-                # Check if this is a heading using Challenge 1A logic
-                if is_heading(span, base_font_size, page_height):
-                    # Save previous section
-                    if current_section and section_content:
-                        current_section["content"] = " ".join(section_content)
-                        sections.append(current_section)
-                    
-                    # Start new section
-                    level = classify_heading_level(text)
-                    if not level and span["font_size"] in heading_level_map:
-                        level = heading_level_map[span["font_size"]]
-                    
+                # Start new section
+                level = classify_heading_level(text)
+                if not level and span.font_size in heading_level_map:
+                    level = heading_level_map[span.font_size]
+                
+                current_section = {
+                    "document": doc_name,
+                    "section_title": text,
+                    "page_number": page_num + 1,
+                    "font_size": span.font_size,
+                    "level": level or "H1"
+                }
+                section_content = []
+            else:
+                # Add to current section content
+                if current_section:
+                    section_content.append(text)
+                else:  # First content without heading
+                    introduction = True
                     current_section = {
                         "document": doc_name,
-                        "section_title": text,
+                        "section_title": f"Introduction - {doc_name.replace('.pdf', '')}",
                         "page_number": page_num + 1,
-                        "font_size": span["font_size"],
-                        "level": level or "H1"
+                        "font_size": base_font_size,
+                        "level": "H1"
                     }
-                    section_content = []
+                    section_content = [text]
+        
+        # Don't forget the last section on the page
+        if current_section and section_content:
+            page_sections.append((current_section, section_content))
+        return page_sections, introduction
+    
+    def extract_section_shard(self, doc, doc_name, pages):
+        """Sections of a page range as if it started the document, and whether the first is an introduction"""
+        # merge_section_shards drops that introduction when an earlier shard has sections
+        doc = as_parsed_document(doc)
+        section_parts = []
+        leading_introduction = False
+        for page_num in pages:
+            page_sections, introduction = self.page_section_parts(doc, doc_name, page_num, bool(section_parts))
+            if introduction:
+                if section_parts:
+                    del page_sections[0]
                 else:
-                    # Add to current section content
-                    if current_section:
-                        section_content.append(text)
-                    elif not sections:  # First content without heading
-                        current_section = {
-                            "document": doc_name,
-                            "section_title": f"Introduction - {doc_name.replace('.pdf', '')}",
-                            "page_number": page_num + 1,
-                            "font_size": base_font_size,
-                            "level": "H1"
-                        }
-                        section_content = [text]
+                    leading_introduction = True
+            section_parts.extend(page_sections)
+            doc.release(page_num)
+        return DocumentSections.build(section_parts), leading_introduction
+    
+    @staticmethod
+    def merge_section_shards(shards):
+        """Join (sections, leading introduction) results of consecutive page ranges in page order"""
+        section_parts = []
+        for sections, leading_introduction in shards:
+            for index, section in enumerate(sections.sections):
+                if index == 0 and leading_introduction and section_parts:
+                    continue
+                section_parts.append((section, [sections.content(index)]))
+        return DocumentSections.build(section_parts)
+    
+    def extract_sections_until(self, doc, doc_name, pages, stop_at):
+        """Sections of the given pages, stopping at the first page reached after stop_at; also returns the pages done"""
+        doc = as_parsed_document(doc)
+        section_parts = []
+        pages_done = 0
+        for page_num in pages:
+            if time.perf_counter() >= stop_at:
+                break
+            page_sections, introduction = self.page_section_parts(doc, doc_name, page_num, bool(section_parts))
+            if introduction and section_parts:
+                del page_sections[0]
+            section_parts.extend(page_sections)
+            pages_done += 1
+            doc.release(page_num)
+        return DocumentSections.build(section_parts), pages_done
+    
+    def get_document_sections(self, pdf_path, filename):
+        """Sections of one PDF, extracted once per run and shared by all personas"""
+        real_path = os.path.realpath(pdf_path)
+        digest = self._path_digests.get(real_path)
+        if digest is None:
+            digest = self._path_digests[real_path] = file_digest(pdf_path)
+        
+        # Section titles and document fields embed the filename, so it is part of the key
+        store_key = (digest, filename)
+        sections = self.document_sections.get(store_key)
+        if sections is None:
+            sections = self._load_document_sections(pdf_path, filename, digest)
+            self.document_sections[store_key] = sections
+        return sections
+    
+    def request_analyzer(self):
+        """A fresh analyzer for one service request, sharing this one's section store, cache and pool"""
+        # Persona state is per request; path digests too, since files may change between requests
+        analyzer = PersonaDrivenAnalyzer(cache=self.cache, workers=self.workers, prefetch=self.prefetch,
+                                         document_font_stats=self.document_font_stats,
+                                         shard_pages=self.shard_pages, collection_budget=self.collection_budget,
+                                         prefilter=self.prefilter, max_worker_rss_mb=self.max_worker_rss_mb,
+                                         mupdf_store_mb=self.mupdf_store_mb)
+        analyzer.document_sections = self.document_sections
+        analyzer.extractors = self.extractors
+        return analyzer
+    
+    def iter_collection_sections(self, input_dir, documents):
+        """Yield (filename, sections) for every readable document, in input order"""
+        pdf_paths = []
+        for doc_info in documents:
+            filename = doc_info.get("filename", "")
+            pdf_path = os.path.join(input_dir, "PDFs", filename)
+            if os.path.exists(pdf_path):
+                pdf_paths.append((filename, pdf_path))
+        
+        if self.workers <= 1 and self.extractors is None:
+            for filename, pdf_path in pdf_paths:
+                try:
+                    sections = self.get_document_sections(pdf_path, filename)
+                except Exception as e:
+                    print(f"Error processing {filename}: {e}")
+                    continue
+                yield filename, sections
+            return
+        
+        # Up to `prefetch` documents are in flight: a thread reads and hashes the
+        # bytes, then hands cache misses to an extraction process and waits for
+        # it, so there are never fewer threads than workers or processes would
+        # sit idle. Results are consumed strictly in input order, so the output
+        # stays deterministic.
+        in_flight = max(self.prefetch, self.workers)
+        with contextlib.ExitStack() as stack:
+            readers = stack.enter_context(ThreadPoolExecutor(max_workers=in_flight))
+            extractors = self.extractors
+            if extractors is None:
+                extractors = stack.enter_context(
+                    RecyclingExecutor(self.workers, self.max_worker_rss_mb, self.mupdf_store_mb)
+                )
+            pending = deque()
+            jobs = iter(pdf_paths)
             
-            # Don't forget the last section on the page
-            if current_section and section_content:
-                current_section["content"] = " ".join(section_content)
-                sections.append(current_section)
-                current_section = None
-                section_content = []
+            def submit_next():
+                for filename, pdf_path in jobs:
+                    future = readers.submit(self._prefetch_document, extractors, pdf_path, filename)
+                    pending.append((filename, pdf_path, future))
+                    return
+            
+            for _ in range(in_flight):
+                submit_next()
+            
+            while pending:
+                filename, pdf_path, future = pending.popleft()
+                submit_next()
+                try:
+                    sections = self._store_prefetched_document(pdf_path, filename, *future.result())
+                except BrokenProcessPool:
+                    # Every later document would fail the same way: fail the
+                    # collection, so the service can replace the pool
+                    raise
+                except Exception as e:
+                    print(f"Error processing {filename}: {e}")
+                    continue
+                yield filename, sections
+    
+    def _prefetch_document(self, extractors, pdf_path, filename):
+        """Hash one PDF, then extract it in a worker process unless already known"""
+        # Known documents are never copied into the (often small) /dev/shm
+        digest = file_digest(pdf_path)
+        sections = self.document_sections.get((digest, filename))
+        if sections is not None:
+            return digest, "store", sections, None, None
+        if self.cache is not None:
+            cached = self.cache.lookup(self._cache_key(digest, filename))
+            if cached is not None:
+                return digest, "cache", DocumentSections.from_json(cached), None, None
         
-        return sections, title
+        source, shm = DocumentSource.to_shared_memory(pdf_path)
+        try:
+            sections, title, report = self._extract_prefetched_document(extractors, source, filename)
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        return digest, "extracted", sections, title, report
+    
+    def _extract_prefetched_document(self, extractors, source, filename):
+        """Extract a prefetched document in the worker processes, split into page ranges when long"""
+        # Documents with document-wide font statistics are never split: their
+        # heading sizes depend on every page classified before
+        shards = None
+        if self.shard_pages > 0 and not self.document_font_stats:
+            page_count = extractors.submit(_read_page_count, source).result()
+            if page_count > self.shard_pages:
+                shards = page_shards(page_count, self.shard_pages)
+        if shards is None:
+            return extractors.submit(
+                _extract_sections_from_source, source, filename, self.collect_metrics, self.profile_dir,
+                self.document_font_stats, self.prefilter
+            ).result()
+        
+        # Shards are not profiled; their metrics add up to one document entry
+        futures = [
+            extractors.submit(_extract_section_shard, source, filename, first, end, self.collect_metrics,
+                              self.prefilter)
+            for first, end in shards
+        ]
+        results = [future.result() for future in futures]
+        sections = self.merge_section_shards((shard, leading) for shard, leading, _, _ in results)
+        report = None
+        if self.collect_metrics:
+            metrics = StageMetrics(filename)
+            for *_, shard_report in results:
+                metrics.merge(shard_report)
+            metrics.count("shards", len(results))
+            metrics.count("sections", len(sections))
+            report = metrics.as_dict()
+            report["peak_rss_mb"] = max(shard_report["peak_rss_mb"] for *_, shard_report in results)
+        return sections, results[0][2], report
+    
+    def _store_prefetched_document(self, pdf_path, filename, digest, source, sections, title, report):
+        """Record a prefetched document in the section store and result cache"""
+        self._path_digests[os.path.realpath(pdf_path)] = digest
+        store_key = (digest, filename)
+        if store_key in self.document_sections:
+            # A duplicate still in flight when its twin was stored: keep the first
+            return self.document_sections[store_key]
+        
+        if self.cache is not None and source != "store":
+            self.cache.record(source == "cache")
+            if source == "extracted":
+                self.cache.put(self._cache_key(digest, filename), sections.to_json(title))
+        if report is not None:
+            self.document_metrics.append(report)
+        self.document_sections[store_key] = sections
+        return sections
+    
+    def _cache_key(self, digest, filename):
+        # Section titles and document fields embed the filename, so it salts the key
+        salt = filename + "|font-stats" if self.document_font_stats else filename
+        return self.cache.key_for(digest, salt=salt)
+    
+    def _load_document_sections(self, pdf_path, filename, digest):
+        """Extract one PDF's sections, or read them from the result cache when unchanged"""
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(digest, filename)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return DocumentSections.from_json(cached)
+        
+        sections, title, report = _extract_sections_from_source(
+            DocumentSource.from_path(pdf_path), filename, self.collect_metrics, self.profile_dir,
+            self.document_font_stats, self.prefilter
+        )
+        if report is not None:
+            self.document_metrics.append(report)
+        if cache_key is not None:
+            self.cache.put(cache_key, sections.to_json(title))
+        return sections
     
     def calculate_importance_score(self, section):
         """Calculate importance score based on persona keywords"""
         title = section.get("section_title", "").lower()
         content = section.get("content", "").lower()
-        text = title + " " + content
-        
-        score = 0
         
         # High importance keywords (5x multiplier for title, 3x for content)
-        for keyword in self.importance_keywords.get('high', []):
-            title_matches = title.count(keyword.lower()) * 5
-            content_matches = content.count(keyword.lower()) * 3
-            score += title_matches + content_matches
-        
         # Medium importance keywords (2x multiplier)
-        for keyword in self.importance_keywords.get('medium', []):
-            score += text.count(keyword.lower()) * 2
-        
+        score = self.keyword_matcher.score(title, content)
+        return self.add_structure_bonuses(section, len(content), score)
+    
+    def score_document(self, document):
+        """calculate_importance_score of every section of a DocumentSections, in order"""
+        # Content is scored in place on the document's lowercased buffer; only
+        # a buffer whose offsets lowercasing would move is lowered per section
+        lower = document.lower_text()
+        scores = []
+        for index, section in enumerate(document.sections):
+            title = section.get("section_title", "").lower()
+            if lower is not None:
+                start, end = document.span(index)
+                score = self.keyword_matcher.score_span(title, lower, start, end)
+                content_length = end - start
+            else:
+                content = document.content(index).lower()
+                score = self.keyword_matcher.score(title, content)
+                content_length = len(content)
+            scores.append(self.add_structure_bonuses(section, content_length, score))
+        return scores
+    
+    def add_structure_bonuses(self, section, content_length, score):
+        """Add the keyword-independent length, position and level bonuses to a score"""
         # Content quality bonuses
-        content_length = len(content)
         if content_length > 300:
             score += min(content_length / 300, 3)
         
@@ -406,82 +1930,303 @@ class PersonaDrivenAnalyzer:
         
         return subsections[:max_subsections]
     
-    def process_document_collection(self, input_file_path):
+    def process_document_collection(self, input_file_path, metrics=None):
         """Main processing function"""
         # Read input configuration
         with open(input_file_path, 'r', encoding='utf-8') as f:
             config = json.load(f)
         
+        return self.process_collection_config(config, os.path.dirname(input_file_path), metrics)
+    
+    def process_collection_config(self, config, input_dir, metrics=None):
+        """process_document_collection for an already parsed input config; PDFs are read from input_dir/PDFs"""
         documents = config.get("documents", [])
         persona = config.get("persona", {})
         job_to_be_done = config.get("job_to_be_done", {})
         
+        if self.collection_budget:
+            return self.process_collection_within_budget(config, input_dir, metrics)
+        
         # Setup persona-specific keywords
         self.setup_persona_keywords(persona, job_to_be_done)
         
-        all_sections = []
-        input_dir = os.path.dirname(input_file_path)
+        # Sections below each document's cutoff are kept without their content
+        top_sections = TopSectionSelector()
         
         # Process each document
+        for filename, sections in self.iter_collection_sections(input_dir, documents):
+            try:
+                self._score_into(top_sections, sections, metrics)
+            except Exception as e:
+                print(f"Error processing {filename}: {e}")
+                continue
+        
+        # Sections by importance, read only as far as the selection needs
+        return self.build_collection_output(documents, persona, job_to_be_done, top_sections.ranked(), metrics)
+    
+    def _score_into(self, top_sections, sections, metrics=None, position=None):
+        """Score one document's sections and offer them to a TopSectionSelector"""
+        # Persona scoring is a cheap pass over the shared, read-only sections
+        with stage_timer(metrics, "scoring"):
+            scored_sections = [
+                dict(section, importance_score=score)
+                for section, score in zip(sections, self.score_document(sections))
+            ]
+            
+            top_sections.add_document(scored_sections, sections, position)
+        if metrics is not None:
+            metrics.count("documents")
+            metrics.count("sections_scored", len(sections))
+    
+    def process_collection_within_budget(self, config, input_dir, metrics=None):
+        """process_collection_config that returns within collection_budget seconds, reducing documents if needed"""
+        # Documents run one at a time in this process, so extraction can stop
+        # between any two pages. Cheap and persona-relevant documents go first;
+        # sections are still ranked in input order, so an output that needed no
+        # reduction is the same as without a budget.
+        budget = CollectionBudget(self.collection_budget)
+        documents = config.get("documents", [])
+        persona = config.get("persona", {})
+        job_to_be_done = config.get("job_to_be_done", {})
+        self.setup_persona_keywords(persona, job_to_be_done)
+        
+        planned = []
+        for position, doc_info in enumerate(documents):
+            filename = doc_info.get("filename", "")
+            pdf_path = os.path.join(input_dir, "PDFs", filename)
+            if not os.path.exists(pdf_path):
+                continue
+            if time.perf_counter() >= budget.extraction_deadline():
+                # Not even opened: skipped with an unknown page count
+                budget.reduce(filename, None, 0)
+                continue
+            try:
+                with fitz.open(pdf_path) as doc:
+                    page_count = len(doc)  # reads the page tree only, no text
+            except Exception as e:
+                print(f"Error processing {filename}: {e}")
+                continue
+            size = os.path.getsize(pdf_path)
+            # Relevance before extraction: persona keywords in the listed title and filename
+            relevance = self.keyword_matcher.score(f"{doc_info.get('title', '')} {filename}".lower(), "")
+            cost = budget.estimate(page_count, size)
+            planned.append((cost / (1 + relevance), position, filename, pdf_path, page_count, size))
+        planned.sort()
+        
+        top_sections = TopSectionSelector()
+        for _, position, filename, pdf_path, page_count, size in planned:
+            try:
+                sections = self._budgeted_document_sections(budget, pdf_path, filename, page_count, size)
+                if sections is not None:
+                    self._score_into(top_sections, sections, metrics, position)
+            except Exception as e:
+                print(f"Error processing {filename}: {e}")
+                continue
+        if metrics is not None:
+            metrics.count("reduced_documents", len(budget.reduced_documents))
+        
+        return self.build_collection_output(documents, persona, job_to_be_done, top_sections.ranked(), metrics,
+                                            budget)
+    
+    def _budgeted_document_sections(self, budget, pdf_path, filename, page_count, size):
+        """Sections of one document: complete when known or affordable, else from a sample of its pages"""
+        real_path = os.path.realpath(pdf_path)
+        digest = self._path_digests.get(real_path)
+        if digest is None:
+            # Hashing reads the whole file, so a document that does not fit is
+            # skipped before it, even if it would have been known
+            if not budget.affordable_pages(page_count, size):
+                budget.reduce(filename, page_count, 0)
+                return None
+            digest = self._path_digests[real_path] = file_digest(pdf_path)
+        store_key = (digest, filename)
+        sections = self.document_sections.get(store_key)
+        if sections is not None:
+            return sections
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(digest, filename)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                sections = self.document_sections[store_key] = DocumentSections.from_json(cached)
+                return sections
+        
+        affordable = budget.affordable_pages(page_count, size)
+        if not affordable:
+            budget.reduce(filename, page_count, 0)
+            return None
+        pages = range(page_count) if affordable == page_count else sample_pages(page_count, affordable)
+        
+        start = time.perf_counter()
+        metrics = StageMetrics(filename) if self.collect_metrics else None
+        with stage_timer(metrics, "open"):
+            doc = ParsedDocument(fitz.open(pdf_path), metrics,
+                                 FontStatistics() if self.document_font_stats else None, self.prefilter)
+        with doc:
+            title = None
+            if cache_key is not None:
+                with stage_timer(metrics, "title"):
+                    title = extract_title_from_first_page(doc)
+            with stage_timer(metrics, "section_building"):
+                sections, pages_done = self.extract_sections_until(doc, filename, pages, budget.extraction_deadline())
+        budget.observe(pages_done, time.perf_counter() - start)
+        if metrics is not None:
+            metrics.count("sections", len(sections))
+            report = metrics.as_dict()
+            report["peak_rss_mb"] = peak_rss_mb()
+            self.document_metrics.append(report)
+        
+        # Only complete documents are shared with later collections and runs
+        if pages_done < page_count:
+            budget.reduce(filename, page_count, pages_done)
+            return sections
+        if cache_key is not None:
+            self.cache.put(cache_key, sections.to_json(title))
+        self.document_sections[store_key] = sections
+        return sections
+    
+    def build_section_index(self, input_file_path):
+        """Index every section of a collection for repeated persona queries"""
+        with open(input_file_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        
+        documents = config.get("documents", [])
+        index = SectionIndex([doc["filename"] for doc in documents])
+        input_dir = os.path.dirname(input_file_path)
+        
         for doc_info in documents:
             filename = doc_info.get("filename", "")
             pdf_path = os.path.join(input_dir, "PDFs", filename)
             
             if not os.path.exists(pdf_path):
                 continue
-                
+            
             try:
-                doc = fitz.open(pdf_path)
-                sections, title = self.extract_enhanced_sections_from_doc(doc, filename)
-                
-                # Calculate importance scores
-                for section in sections:
-                    section["importance_score"] = self.calculate_importance_score(section)
-                
-                all_sections.extend(sections)
-                doc.close()
-                
+                sections = self.get_document_sections(pdf_path, filename)
             except Exception as e:
                 print(f"Error processing {filename}: {e}")
                 continue
+            
+            index.document_digests[filename] = self._path_digests[os.path.realpath(pdf_path)]
+            for section in sections.materialized():
+                index.add_section(section)
+        
+        return index
+    
+    def process_collection_with_index(self, input_file_path, index_path, metrics=None):
+        """process_document_collection answered from a saved section index"""
+        with open(input_file_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        
+        index = None
+        if os.path.exists(index_path):
+            index = SectionIndex.load(index_path)
+        # Rebuild when the collection's PDFs changed since the index was saved
+        if index is None or index.document_digests != self._collection_digests(input_file_path, config):
+            index = self.build_section_index(input_file_path)
+            index.save(index_path)
+        
+        return self.query_index(index, config.get("persona", {}), config.get("job_to_be_done", {}), metrics)
+    
+    def _collection_digests(self, input_file_path, config):
+        input_dir = os.path.dirname(input_file_path)
+        digests = {}
+        for doc_info in config.get("documents", []):
+            filename = doc_info.get("filename", "")
+            pdf_path = os.path.join(input_dir, "PDFs", filename)
+            if os.path.exists(pdf_path):
+                real_path = os.path.realpath(pdf_path)
+                if real_path not in self._path_digests:
+                    self._path_digests[real_path] = file_digest(pdf_path)
+                digests[filename] = self._path_digests[real_path]
+        return digests
+    
+    def query_index(self, index, persona, job_to_be_done, metrics=None):
+        """Rank indexed sections for a persona by walking only the postings of its keywords"""
+        self.setup_persona_keywords(persona, job_to_be_done)
+        
+        # Sections without any keyword hit score exactly their structure bonuses,
+        # which are persona-independent and ranked once per index
+        if index.base_ranking is None:
+            base_scores = [
+                self.add_structure_bonuses(section, len(section.get("content", "").lower()), 0)
+                for section in index.sections
+            ]
+            index.base_ranking = sorted(((-score, section_id) for section_id, score in enumerate(base_scores)))
         
-        # Sort sections by importance
-        all_sections.sort(key=lambda x: x["importance_score"], reverse=True)
+        matcher = self.keyword_matcher
+        keywords = list(matcher.title_weights) + [keyword for keyword, *_ in matcher.direct_keywords]
+        candidates = index.candidate_sections(keywords)
+        if candidates is None:
+            candidates = range(len(index.sections))
+        
+        # (-score, section id) pairs sort like the stable descending sort of
+        # process_document_collection, so both streams merge into the same ranking
+        with stage_timer(metrics, "scoring"):
+            scored = sorted((-self.calculate_importance_score(index.sections[section_id]), section_id)
+                            for section_id in candidates)
+        if metrics is not None:
+            metrics.count("sections_scored", len(scored))
+        candidates = {section_id for _, section_id in scored}
+        unmatched = (entry for entry in index.base_ranking if entry[1] not in candidates)
+        ranked_sections = (
+            dict(index.sections[section_id], importance_score=-negative_score)
+            for negative_score, section_id in heapq.merge(scored, unmatched)
+        )
+        
+        documents = [{"filename": filename} for filename in index.documents]
+        return self.build_collection_output(documents, persona, job_to_be_done, ranked_sections, metrics)
+    
+    def build_collection_output(self, documents, persona, job_to_be_done, ranked_sections, metrics=None,
+                                budget=None):
+        """Select diverse top sections and subsections from sections in rank order"""
+        # ranked_sections may be a lazy iterator: only the prefix needed is consumed
+        ranked_sections = iter(ranked_sections)
+        top_sections = []
         
         # Prepare extracted sections with diversity
         extracted_sections = []
-        seen_titles = set()
+        seen_titles = TitleDeduplicator()
         doc_coverage = defaultdict(int)
         max_per_doc = 3
         
-        for section in all_sections:
-            title = section["section_title"].strip()
-            doc_name = section["document"]
-            title_lower = title.lower()
-            
-            # Skip duplicates and enforce diversity
-            is_duplicate = any(title_lower in seen.lower() or seen.lower() in title_lower 
-                             for seen in seen_titles if len(title_lower) > 10)
-            
-            if (not is_duplicate and 
-                len(title) > 3 and 
-                doc_coverage[doc_name] < max_per_doc and
-                len(extracted_sections) < 25):
+        # Ranking is lazy: this stage includes merging the per-document rankings
+        with stage_timer(metrics, "selection"):
+            for section in ranked_sections:
+                top_sections.append(section)
+                title = section["section_title"].strip()
+                doc_name = section["document"]
+                title_lower = title.lower()
                 
-                extracted_sections.append({
-                    "document": doc_name,
-                    "section_title": title,
-                    "importance_rank": len(extracted_sections) + 1,
-                    "page_number": section["page_number"]
-                })
-                seen_titles.add(title_lower)
-                doc_coverage[doc_name] += 1
+                # Skip duplicates and enforce diversity
+                is_duplicate = len(title_lower) > 10 and seen_titles.overlaps(title_lower)
                 
-            if len(extracted_sections) >= 25:
-                break
+                if (not is_duplicate and 
+                    len(title) > 3 and 
+                    doc_coverage[doc_name] < max_per_doc and
+                    len(extracted_sections) < 25):
+                    
+                    extracted_sections.append({
+                        "document": doc_name,
+                        "section_title": title,
+                        "importance_rank": len(extracted_sections) + 1,
+                        "page_number": section["page_number"]
+                    })
+                    seen_titles.add(title_lower)
+                    doc_coverage[doc_name] += 1
+                
+                if len(extracted_sections) >= 25:
+                    break
         
-        # Generate subsection analysis
-        subsection_analysis = self.extract_subsections(all_sections)
+        # Generate subsection analysis (extract_subsections reads the 15 best sections)
+        top_sections.extend(itertools.islice(ranked_sections, max(0, 15 - len(top_sections))))
+        if budget is not None and not budget.allows_subsections():
+            # Out of time: the ranked sections are still reported, without chunks
+            budget.subsections_skipped = True
+            subsection_analysis = []
+        else:
+            with stage_timer(metrics, "subsection_chunking"):
+                subsection_analysis = self.extract_subsections(top_sections)
         
         # Prepare output
         output = {
@@ -494,16 +2239,329 @@ class PersonaDrivenAnalyzer:
             "extracted_sections": extracted_sections,
             "subsection_analysis": subsection_analysis
         }
+        if budget is not None:
+            output["metadata"].update(budget.metadata())
         
         return output
 
+class SectionStore(OrderedDict):
+    """(content hash, filename) -> sections, bounded for a long-running service"""
+    
+    def __init__(self, max_documents):
+        super().__init__()
+        self.max_documents = max_documents
+    
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        # Oldest documents go first; the result cache still has them on disk
+        while len(self) > self.max_documents:
+            self.popitem(last=False)
+
+class ServiceBusy(Exception):
+    pass
+
+class RequestLimiter:
+    # Backpressure for the HTTP service: at most max_pending requests are
+    # admitted (waiting or running) and at most max_active run at once.
+    # Requests beyond max_pending are refused right away instead of queueing
+    # without bound.
+    def __init__(self, max_active, max_pending):
+        self._admitted = threading.BoundedSemaphore(max(max_pending, max_active))
+        self._active = threading.BoundedSemaphore(max_active)
+
+    @contextlib.contextmanager
+    def slot(self):
+        if not self._admitted.acquire(blocking=False):
+            raise ServiceBusy()
+        try:
+            with self._active:
+                yield
+        finally:
+            self._admitted.release()
+
+class CollectionService:
+    """process_document_collection behind a warm extraction pool and a shared section store"""
+    
+    def __init__(self, input_root, workers=2, max_active=2, max_pending=16, cache=None, max_documents=512,
+                 shard_pages=0, max_worker_rss_mb=1024, mupdf_store_mb=0):
+        # Collections are resolved under input_root and documents under the
+        # collection's PDFs folder only, so a request cannot make the service
+        # read arbitrary paths
+        self.input_root = os.path.realpath(input_root)
+        self.workers = workers
+        self.limiter = RequestLimiter(max_active, max_pending)
+        self.analyzer = PersonaDrivenAnalyzer(cache=cache, workers=workers, shard_pages=shard_pages,
+                                              max_worker_rss_mb=max_worker_rss_mb, mupdf_store_mb=mupdf_store_mb)
+        self.analyzer.document_sections = SectionStore(max_documents)
+        self._pool_lock = threading.Lock()
+        self._start_pool()
+    
+    def _start_pool(self):
+        """Fork every extraction worker up front so no request pays for it"""
+        self.analyzer.extractors = RecyclingExecutor(self.workers, self.analyzer.max_worker_rss_mb,
+                                                     self.analyzer.mupdf_store_mb)
+        for future in [self.analyzer.extractors.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+    
+    def _replace_broken_pool(self, extractors):
+        """Replace a broken pool once, however many requests it failed"""
+        with self._pool_lock:
+            if self.analyzer.extractors is extractors:
+                extractors.shutdown(wait=False)
+                self._start_pool()
+    
+    def collection_dir(self, collection):
+        """Folder of a requested collection, which must lie inside input_root"""
+        if not isinstance(collection, str):
+            raise ValueError(f"unknown collection: {collection!r}")
+        path = os.path.realpath(os.path.join(self.input_root, collection))
+        if os.path.commonpath([path, self.input_root]) != self.input_root or not os.path.isdir(path):
+            raise ValueError(f"unknown collection: {collection}")
+        return path
+    
+    def check_request(self, request, input_dir):
+        """Reject collection configs that are malformed or name PDFs outside <collection>/PDFs"""
+        for key in ("persona", "job_to_be_done"):
+            if not isinstance(request.get(key, {}), dict):
+                raise ValueError(f"{key} must be a JSON object")
+        documents = request.get("documents", [])
+        if not isinstance(documents, list):
+            raise ValueError("documents must be a list")
+        pdf_dir = os.path.realpath(os.path.join(input_dir, "PDFs"))
+        for document in documents:
+            filename = document.get("filename") if isinstance(document, dict) else None
+            if not isinstance(filename, str) or filename in ("", ".", "..") or os.path.basename(filename) != filename:
+                raise ValueError(f"invalid document filename: {filename!r}")
+            path = os.path.realpath(os.path.join(pdf_dir, filename))
+            if os.path.dirname(path) != pdf_dir:
+                raise ValueError(f"invalid document filename: {filename!r}")
+    
+    def collection_json(self, request):
+        """Same JSON as the batch writes to <collection>_output.json"""
+        if not isinstance(request, dict):
+            raise ValueError("request body must be a JSON object")
+        input_dir = self.collection_dir(request.get("collection", ""))
+        self.check_request(request, input_dir)
+        analyzer = self.analyzer.request_analyzer()
+        try:
+            result = analyzer.process_collection_config(request, input_dir)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed): replace the pool for later requests
+            self._replace_broken_pool(analyzer.extractors)
+            raise
+        return json.dumps(result, indent=2, ensure_ascii=False).encode("utf-8")
+    
+    def close(self):
+        self.analyzer.extractors.shutdown()
+
+class CollectionRequestHandler(BaseHTTPRequestHandler):
+    """POST /collection with a challenge1b_input.json body plus "collection"; GET /health"""
+    
+    service = None
+    # The body is read before admission, so its size is capped; a request
+    # only names its documents, which are read from the collection folder
+    max_request_bytes = 1 << 20
+    
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, {
+            "status": "ok",
+            "workers": self.service.workers,
+            "documents_in_memory": len(self.service.analyzer.document_sections),
+        })
+    
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != "/collection":
+            self._send_json(404, {"error": "not found"})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self._send_json(411, {"error": "Content-Length required"})
+            return
+        if not re.fullmatch(r"[0-9]+", length):
+            # Where the body ends is unknown, so the connection is not reused
+            self.close_connection = True
+            self._send_json(400, {"error": f"invalid Content-Length: {length!r}"})
+            return
+        if int(length) > self.max_request_bytes:
+            self.close_connection = True
+            self._send_json(413, {"error": f"request body over {self.max_request_bytes} bytes"})
+            return
+        
+        try:
+            request = json.loads(self.rfile.read(int(length)))
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON: {e}"})
+            return
+        
+        try:
+            with self.service.limiter.slot():
+                body = self.service.collection_json(request)
+        except ServiceBusy:
+            self._send_json(503, {"error": "too many pending requests"}, {"Retry-After": "1"})
+            return
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send(200, body)
+    
+    def _send_json(self, status, payload, headers=None):
+        self._send(status, json.dumps(payload).encode("utf-8"), headers)
+    
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(input_root, host, port, workers=2, max_active=2, max_pending=16, cache=None, max_documents=512,
+          shard_pages=0, max_worker_rss_mb=1024, mupdf_store_mb=0):
+    """Run the collection service until Ctrl+C or SIGTERM"""
+    limit_mupdf_store(mupdf_store_mb)
+    service = CollectionService(input_root, workers=workers, max_active=max_active, max_pending=max_pending,
+                                cache=cache, max_documents=max_documents, shard_pages=shard_pages,
+                                max_worker_rss_mb=max_worker_rss_mb, mupdf_store_mb=mupdf_store_mb)
+    handler = type("BoundCollectionRequestHandler", (CollectionRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    # docker stop sends SIGTERM: shut down as cleanly as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"🚀 Serving collections under {service.input_root} on http://{host}:{port}/collection")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+def verify_prefilter(input_root):
+    """Extract every collection document with and without prefilter; return the ones whose sections differ"""
+    mismatches = []
+    pages = prefiltered = 0
+    analyzer = PersonaDrivenAnalyzer()
+    for root, _, files in sorted(os.walk(input_root)):
+        if "challenge1b_input.json" not in files:
+            continue
+        with open(os.path.join(root, "challenge1b_input.json"), encoding="utf-8") as f:
+            documents = json.load(f).get("documents", [])
+        for filename in sorted({document["filename"] for document in documents}):
+            extracted = []
+            for prefilter in (False, True):
+                metrics = StageMetrics(filename)
+                try:
+                    pdf = fitz.open(os.path.join(root, "PDFs", filename))
+                    with ParsedDocument(pdf, metrics, prefilter=prefilter) as doc:
+                        sections, title = analyzer.extract_enhanced_sections_from_doc(doc, filename)
+                    extracted.append((title, sections.materialized()))
+                except Exception as e:
+                    extracted.append(str(e))
+            pages += metrics.counters["pages"]
+            prefiltered += metrics.counters["prefiltered_pages"]
+            if extracted[0] != extracted[1]:
+                mismatches.append(os.path.join(root, filename))
+                print(f"❌ Prefilter changes the sections of {filename} in {root}")
+    print(f"🔎 Prefilter skipped {prefiltered} of {pages} pages; "
+          f"{len(mismatches)} of the documents differ from the full path")
+    return mismatches
+
 def main():
     """Process all collections in the input directory"""
-    analyzer = PersonaDrivenAnalyzer()
-    input_dir = "/app/input"
-    output_dir = "/app/output"
+    parser = argparse.ArgumentParser(description="Rank PDF sections for each persona collection")
+    parser.add_argument("--input", default="/app/input", help="folder searched for challenge1b_input.json files")
+    parser.add_argument("--output", default="/app/output", help="folder the collection outputs are written to")
+    parser.add_argument("--cache-dir", default=None,
+                        help="reuse sections of unchanged PDFs from this on-disk cache")
+    parser.add_argument("--cache-max-mb", type=int, default=256,
+                        help="evict least recently used cache entries beyond this size")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="drop every cached result before processing")
+    parser.add_argument("--index-dir", default=None,
+                        help="answer collections from persistent section indexes kept in this folder")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="extraction processes; above 1, PDFs are prefetched and parsed in parallel")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="documents read ahead of the one being scored when --workers > 1 (at least --workers)")
+    parser.add_argument("--shard-pages", type=int, default=0, metavar="N",
+                        help="with --workers > 1, split PDFs longer than N pages into N-page ranges "
+                             "extracted in parallel (0 = whole documents only)")
+    parser.add_argument("--collection-budget", type=float, default=0, metavar="SECONDS",
+                        help="finish every collection within this many seconds, sampling pages of or "
+                             "skipping documents that do not fit (0 = no limit; documents are then extracted "
+                             "one at a time in this process, and --index-dir is not budgeted)")
+    parser.add_argument("--max-worker-rss-mb", type=int, default=1024,
+                        help="replace the extraction processes once one of them holds more resident memory "
+                             "than this after a PDF (0 = never)")
+    parser.add_argument("--mupdf-store-mb", type=int, default=0,
+                        help="empty MuPDF's object and glyph caches between PDFs once a process has grown "
+                             "this much since they were last emptied (0 = after every PDF)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="write per-document and per-collection stage timings to <output>/metrics.json")
+    parser.add_argument("--profile-slowest", type=int, default=0, metavar="N",
+                        help="keep cProfile and tracemalloc dumps of the N slowest PDFs in <output>/profiles")
+    parser.add_argument("--document-font-stats", action="store_true",
+                        help="derive body and heading sizes from a document-wide, sampled font-size "
+                             "histogram instead of per page (may change outputs)")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="skip building the spans of pages whose sizes rule out a new section "
+                             "(same outputs; see --verify-prefilter)")
+    parser.add_argument("--verify-prefilter", action="store_true",
+                        help="extract every collection document with and without --prefilter, "
+                             "report documents whose sections differ, and exit")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as an HTTP service answering POST /collection for collections under --input")
+    parser.add_argument("--host", default="127.0.0.1", help="address the service listens on")
+    parser.add_argument("--port", type=int, default=8080, help="port the service listens on")
+    parser.add_argument("--max-active", type=int, default=2,
+                        help="collections the service processes at the same time")
+    parser.add_argument("--max-pending", type=int, default=16,
+                        help="requests admitted at once; the service answers 503 beyond this")
+    parser.add_argument("--max-documents", type=int, default=512,
+                        help="documents whose sections the service keeps in memory between requests")
+    args = parser.parse_args()
+    
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, max_bytes=args.cache_max_mb * 2**20)
+        if args.clear_cache:
+            cache.clear()
     
+    if args.verify_prefilter:
+        raise SystemExit(1 if verify_prefilter(args.input) else 0)
+    
+    if args.serve:
+        serve(args.input, args.host, args.port, workers=max(1, args.workers), max_active=max(1, args.max_active),
+              max_pending=args.max_pending, cache=cache, max_documents=args.max_documents,
+              shard_pages=args.shard_pages, max_worker_rss_mb=args.max_worker_rss_mb,
+              mupdf_store_mb=args.mupdf_store_mb)
+        return
+    
+    input_dir = args.input
+    output_dir = args.output
     os.makedirs(output_dir, exist_ok=True)
+    
+    profile_dir = None
+    if args.profile_slowest > 0:
+        profile_dir = os.path.join(output_dir, "profiles")
+        os.makedirs(profile_dir, exist_ok=True)
+    analyzer = PersonaDrivenAnalyzer(cache=cache, workers=args.workers, prefetch=max(1, args.prefetch),
+                                     collect_metrics=args.metrics, profile_dir=profile_dir,
+                                     document_font_stats=args.document_font_stats, shard_pages=args.shard_pages,
+                                     collection_budget=args.collection_budget or None, prefilter=args.prefilter,
+                                     max_worker_rss_mb=args.max_worker_rss_mb, mupdf_store_mb=args.mupdf_store_mb)
+    limit_mupdf_store(args.mupdf_store_mb)
+    collection_metrics = []
+    
+    if args.index_dir:
+        os.makedirs(args.index_dir, exist_ok=True)
     start_time = time.time()
     
     # Look for challenge1b_input.json files in subdirectories
@@ -512,14 +2570,24 @@ def main():
             input_file = os.path.join(root, "challenge1b_input.json")
             
             try:
-                result = analyzer.process_document_collection(input_file)
-                
                 # Determine output filename based on directory structure
                 collection_name = os.path.basename(root)
+                metrics = StageMetrics(collection_name) if args.metrics else None
+                
+                if args.index_dir:
+                    index_name = f"{collection_name}_index-font-stats.json" if args.document_font_stats else f"{collection_name}_index.json"
+                    index_path = os.path.join(args.index_dir, index_name)
+                    result = analyzer.process_collection_with_index(input_file, index_path, metrics)
+                else:
+                    result = analyzer.process_document_collection(input_file, metrics)
+                
                 output_file = os.path.join(output_dir, f"{collection_name}_output.json")
                 
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    json.dump(result, f, indent=2, ensure_ascii=False)
+                with stage_timer(metrics, "json_write"):
+                    with open(output_file, 'w', encoding='utf-8') as f:
+                        json.dump(result, f, indent=2, ensure_ascii=False)
+                if metrics is not None:
+                    collection_metrics.append(metrics.as_dict())
                     
                 print(f"✅ Processed collection: {collection_name}")
                 
@@ -527,6 +2595,15 @@ def main():
                 print(f"❌ Error processing {root}: {e}")
                 continue
     
+    print(f"📚 Unique documents parsed or loaded: {len(analyzer.document_sections)}")
+    if cache is not None:
+        print(f"📦 Cache: {cache.hits} hits, {cache.misses} misses")
+    if profile_dir is not None:
+        keep_slowest_profiles(profile_dir, analyzer.document_metrics, args.profile_slowest)
+    if args.metrics:
+        metrics_path = os.path.join(output_dir, "metrics.json")
+        write_metrics_json(metrics_path, time.time() - start_time, analyzer.document_metrics, collection_metrics)
+        print(f"📊 Metrics written to {metrics_path}")
     print(f"✅ Total execution time: {time.time() - start_time:.2f} seconds")
 
 if __name__ == "__main__":